@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+# This file is part of metav.
+
+# metav is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# metav is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with metav.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time adding many wires to a module with many items
+
+Module.add_item updates the ids of the module with the new item. This
+is compared with building all of them again after each item, as it
+did before."""
+
+import os, sys, time, tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from metav.preproc import preproc
+from metav.parse import parse
+from metav.sourcemap import SourceMap
+
+def module(name, items):
+    lines = ["module %s (a);" % name, "  input a;"]
+    lines.extend("  wire %s%d;" % (name, i) for i in range(items))
+    lines.append("endmodule")
+    return '\n'.join(lines) + '\n'
+
+def load(text):
+    fd, filename = tempfile.mkstemp(suffix='.v')
+    with os.fdopen(fd, 'w') as f:
+        f.write(text)
+    try:
+        sourcemap = SourceMap()
+        return parse(preproc(filename, state={'sourcemap': sourcemap})[0],
+                     sourcemap)[0]
+    finally:
+        os.remove(filename)
+
+def run(items, adds, rebuild):
+    m = load(module('m', items))
+    m.edit_plan = []
+    wires = load(module('w', adds)).items[1:]
+    start = time.perf_counter()
+    for w in wires:
+        m.add_item(w)
+        if rebuild:
+            m._build_ids()
+    elapsed = time.perf_counter() - start
+    assert len(m.ids) == items + adds + 1
+    return elapsed
+
+def main(items, adds):
+    print("%d items, %d wires added" % (items, adds))
+    print("%-12s %10s %12s" % ("ids", "seconds", "us/add"))
+    for name, rebuild in (("rebuilt", True), ("updated", False)):
+        elapsed = run(items, adds, rebuild)
+        print("%-12s %10.3f %12.2f" % (name, elapsed, elapsed / adds * 1e6))
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--items", type=int, default=10000,
+                        help="items in the module")
+    parser.add_argument("--adds", type=int, default=500,
+                        help="wires to add")
+    args = parser.parse_args()
+    main(args.items, args.adds)
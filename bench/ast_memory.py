@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+# This file is part of metav.
+
+# metav is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# metav is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with metav.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Memory taken by the syntax tree of a large netlist
+
+Parses a generated module of wires, assigns and instances, and
+reports the memory still allocated while the tree is kept, per source
+line and per node, as measured by tracemalloc."""
+
+import os, sys, gc, time, tempfile, tracemalloc
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from metav.preproc import preproc
+from metav.parse import parse
+from metav.sourcemap import SourceMap
+import metav.vast as ast
+
+def netlist(lines):
+    "Return the text of a module of about lines lines"
+    text = ["module top (a, b, c);", "  input a, b;", "  input [3:0] c;"]
+    for i in range(lines // 3):
+        text.append("  wire [7:0] w%d;" % i)
+        text.append("  assign w%d = (a & w%d) | {b, c[3:0], w%d[2]};" %
+                    (i, i // 2, i // 3))
+        text.append("  sub u%d (.x(w%d), .y(a));" % (i, i))
+    text.append("endmodule")
+    return '\n'.join(text) + '\n'
+
+def nodes(module):
+    "Count the nodes of module, by following their attributes"
+    seen = set()
+    todo = [module]
+    while todo:
+        node = todo.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        for name in dir(node):
+            if name in ('parent', 'module', 'pos') or name.startswith('__'):
+                continue
+            value = getattr(node, name, None)
+            for v in value if isinstance(value, list) else (value,):
+                if isinstance(v, ast.Ast):
+                    todo.append(v)
+    return len(seen)
+
+def main(lines):
+    fd, filename = tempfile.mkstemp(suffix='.v')
+    with os.fdopen(fd, 'w') as f:
+        f.write(netlist(lines))
+    try:
+        lines = sum(1 for line in open(filename))
+        gc.collect()
+        tracemalloc.start()
+        start = time.perf_counter()
+        sourcemap = SourceMap()
+        modules = parse(preproc(filename, state={'sourcemap': sourcemap})[0],
+                        sourcemap)
+        elapsed = time.perf_counter() - start
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        n = nodes(modules[0])
+    finally:
+        os.remove(filename)
+    print("%d lines, %d nodes, parsed in %.1f s" % (lines, n, elapsed))
+    print("%10s %14s %14s" % ("MB", "bytes/line", "bytes/node"))
+    print("%10.1f %14.0f %14.0f" % (size / 1e6, size / lines, size / n))
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=30000,
+                        help="lines in the netlist")
+    args = parser.parse_args()
+    main(args.lines)
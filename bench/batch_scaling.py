@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+# This file is part of metav.
+
+# metav is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# metav is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with metav.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time process_batch over many generated tops with 1..N workers"""
+
+import os, sys, time, shutil, tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from process import process_batch, find_tops
+
+ITEM = '''  wire w%(n)d;
+  assign w%(n)d = a ^ b;
+'''
+
+def top(name, items):
+    "Return a module named name with items module items"
+    parts = ["module %s(a, b);\n  input a, b;\n" % name]
+    for n in range(items // 2):
+        parts.append(ITEM % {'n': n})
+    parts.append("endmodule\n")
+    return ''.join(parts)
+
+def main(tops, items, jobs):
+    directory = tempfile.mkdtemp()
+    try:
+        for n in range(tops):
+            name = "top%d" % n
+            with open(os.path.join(directory, name + ".v"), 'w') as f:
+                f.write(top(name, items))
+        names = find_tops([directory])
+        print("%d tops of %d items" % (tops, items))
+        print("%6s %10s %10s" % ("jobs", "seconds", "speedup"))
+        base = None
+        for j in jobs:
+            start = time.perf_counter()
+            results = process_batch(names, modpath=[directory], jobs=j)
+            elapsed = time.perf_counter() - start
+            assert not any(r[3] for r in results), [r[3] for r in results if r[3]]
+            base = base or elapsed
+            print("%6d %10.3f %10.2f" % (j, elapsed, base / elapsed))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tops", type=int, default=64,
+                        help="number of tops")
+    parser.add_argument("--items", type=int, default=2000,
+                        help="module items per top")
+    parser.add_argument("--jobs", type=int, nargs="+",
+                        default=sorted(set([1, 2, 4, os.cpu_count() or 1])),
+                        help="worker counts to try")
+    args = parser.parse_args()
+    main(args.tops, args.items, args.jobs)
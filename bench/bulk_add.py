@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+# This file is part of metav.
+
+# metav is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# metav is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with metav.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time generating many assigns with add_item and with add_items
+
+Adds the assigns to a small module one by one and all at once, and
+executes the edit plan, for growing numbers of assigns. The time per
+assign should not grow with them."""
+
+import os, sys, time, tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from metav.preproc import preproc
+from metav.parse import parse
+from metav.sourcemap import SourceMap
+import metav.vast as ast
+import metav.edit
+
+def run(filename, n, bulk):
+    "Return (edit plan entries, seconds adding, seconds executing)"
+    sourcemap = SourceMap()
+    m = parse(preproc(filename, state={'sourcemap': sourcemap})[0],
+              sourcemap)[0]
+    m.edit_plan = []
+    assigns = [ast.ContAssigns([ast.Assign(ast.Id("w%d" % i), "=",
+                                           ast.Id("a"))])
+               for i in range(n)]
+    start = time.perf_counter()
+    if bulk:
+        m.add_items(assigns)
+    else:
+        for a in assigns:
+            m.add_item(a)
+    added = time.perf_counter() - start
+    start = time.perf_counter()
+    metav.edit.execute(m.edit_plan)
+    return len(m.edit_plan), added, time.perf_counter() - start
+
+def main(counts):
+    fd, filename = tempfile.mkstemp(suffix='.v')
+    with os.fdopen(fd, 'w') as f:
+        f.write("module m (a);\n  input a;\nendmodule\n")
+    try:
+        print("%-10s %8s %8s %10s %10s %10s" % ("way", "assigns", "entries",
+                                                "add s", "execute s",
+                                                "us/assign"))
+        for n in counts:
+            for name, bulk in (("add_item", False), ("add_items", True)):
+                entries, added, executed = run(filename, n, bulk)
+                print("%-10s %8d %8d %10.3f %10.3f %10.2f" % (
+                        name, n, entries, added, executed,
+                        (added + executed) / n * 1e6))
+    finally:
+        os.remove(filename)
+        if os.path.exists(filename + ".out"):
+            os.remove(filename + ".out")
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--assigns", type=int, nargs="+",
+                        default=[10000, 25000, 50000],
+                        help="numbers of assigns to generate")
+    args = parser.parse_args()
+    main(args.assigns)
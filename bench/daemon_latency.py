@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+# This file is part of metav.
+
+# metav is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# metav is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with metav.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Request latency of the metav daemon on a generated design
+
+Serves a top instantiating a chain of modules from a temporary
+directory, and times requests when cold, warm, after one module is
+changed, and the re-run of the watched top that the change causes."""
+
+import os, sys, time, shutil, tempfile, threading
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from metav.design import Design
+from metav.daemon import Server, request
+
+LEAF = """module leaf%(n)d (a, y);
+  input [7:0] a;
+  output [7:0] y;
+  wire [7:0] t;
+%(body)s  assign y = t;
+endmodule
+"""
+
+TOP = """module top (a, y);
+  input [7:0] a;
+  output [7:0] y;
+%(insts)s  /*metav
+for name in module.insts:
+    module.insts[name].get_module()
+  */
+endmodule
+"""
+
+def generate(directory, modules, lines):
+    body = ''.join("  assign t = a + %d;\n" % i for i in range(lines))
+    for n in range(modules):
+        with open(os.path.join(directory, "leaf%d.v" % n), 'w') as f:
+            f.write(LEAF % {'n': n, 'body': body})
+    insts = ''.join("  leaf%d u%d (.a(a), .y(y));\n" % (n, n)
+                    for n in range(modules))
+    with open(os.path.join(directory, "top.v"), 'w') as f:
+        f.write(TOP % {'insts': insts})
+
+def timed(path, message):
+    start = time.perf_counter()
+    reply = request(path, message)
+    return reply, time.perf_counter() - start
+
+def run(path, directory, modules, lines):
+    message = {'command': 'process', 'tops': ['top'], 'noop': True}
+    reply, cold = timed(path, message)
+    assert not reply['results'][0][3], reply['results'][0][3]
+    print("%d modules of %d lines" % (modules, lines))
+    print("cold        %8.2f ms" % (cold * 1000))
+    warm = min(timed(path, message)[1] for i in range(20))
+    print("warm        %8.2f ms" % (warm * 1000))
+    leaf = os.path.join(directory, "leaf0.v")
+    parsed = request(path, {'command': 'status'})['parsed']
+    with open(leaf, 'a') as f:
+        f.write("\n")
+    reply, changed = timed(path, message)
+    parsed = request(path, {'command': 'status'})['parsed'] - parsed
+    print("changed     %8.2f ms, %d file(s) parsed again" % (changed * 1000,
+                                                           parsed))
+    # The watch notices a change without being asked
+    parsed = request(path, {'command': 'status'})['parsed']
+    with open(leaf, 'a') as f:
+        f.write("\n")
+    start = time.perf_counter()
+    while request(path, {'command': 'status'})['parsed'] == parsed:
+        time.sleep(0.001)
+    print("watched     %8.2f ms until processed again" % (
+        (time.perf_counter() - start) * 1000))
+
+def main(modules, lines):
+    directory = tempfile.mkdtemp()
+    try:
+        generate(directory, modules, lines)
+        path = os.path.join(directory, 'metav.sock')
+        design = Design(modpath=[directory], incpath=[directory])
+        server = Server(path, design, interval=0.05)
+        thread = threading.Thread(target=server.serve)
+        thread.start()
+        try:
+            run(path, directory, modules, lines)
+        finally:
+            request(path, {'command': 'shutdown'})
+            thread.join()
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modules", type=int, default=50,
+                        help="modules instantiated by the top")
+    parser.add_argument("--lines", type=int, default=200,
+                        help="lines in each module")
+    args = parser.parse_args()
+    main(args.modules, args.lines)
@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+# This file is part of metav.
+
+# metav is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# metav is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with metav.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time deleting every other item of a module with many items
+
+Deletes them one by one, searching for each the way delete_child did
+before, which is quadratic and so is only run with fewer items; one by
+one with item.delete(); one by one inside Module.batch; and all at once
+with Module.delete_items."""
+
+import os, sys, time, pickle, tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from metav.preproc import preproc
+from metav.parse import parse
+from metav.sourcemap import SourceMap
+import metav.vast as ast
+
+def scanned(module, child):
+    "Take child out of module the way delete_child did before"
+    for children in (module.items, module.modports, module.modparams):
+        for n, item in enumerate(children):
+            if item is child:
+                del children[n]
+                module._deleted(child)
+                return
+    assert False, "Could not find child "+repr(child)
+
+def load(items):
+    lines = ["module m (a);", "  input a;"]
+    lines.extend("  wire w%d;" % i for i in range(items))
+    lines.append("endmodule")
+    fd, filename = tempfile.mkstemp(suffix='.v')
+    with os.fdopen(fd, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    try:
+        sourcemap = SourceMap()
+        m = parse(preproc(filename, state={'sourcemap': sourcemap})[0],
+                  sourcemap)[0]
+    finally:
+        os.remove(filename)
+    m.edit_plan = []
+    return pickle.dumps(m)
+
+def run(pickled, way):
+    m = pickle.loads(pickled)
+    items = len(m.items)
+    doomed = m.items[1::2]
+    start = time.perf_counter()
+    if way == "scanned":
+        delete_child = ast.Module.delete_child
+        ast.Module.delete_child = scanned
+        try:
+            for item in doomed:
+                item.delete()
+        finally:
+            ast.Module.delete_child = delete_child
+    elif way == "delete":
+        for item in doomed:
+            item.delete()
+    elif way == "batch":
+        with m.batch():
+            for item in doomed:
+                item.delete()
+    else:
+        m.delete_items(doomed)
+    elapsed = time.perf_counter() - start
+    assert len(m.items) == items - len(doomed)
+    assert len(m.ids) == len(m.items)
+    return len(doomed), elapsed
+
+def main(items, old_items):
+    print("%-14s %8s %8s %10s %10s" % ("way", "items", "deleted", "seconds",
+                                       "us/delete"))
+    for way, n in (("scanned", old_items), ("delete", items),
+                   ("batch", items), ("delete_items", items)):
+        deleted, elapsed = run(load(n), way)
+        print("%-14s %8d %8d %10.3f %10.2f" % (way, n, deleted, elapsed,
+                                               elapsed / deleted * 1e6))
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--items", type=int, default=100000,
+                        help="items in the module")
+    parser.add_argument("--old-items", type=int, default=20000,
+                        help="items in the module for the old way")
+    args = parser.parse_args()
+    main(args.items, args.old_items)
@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+# This file is part of metav.
+
+# metav is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# metav is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with metav.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time metav.edit.execute applying many inserts to one large file
+
+Compares with cutting the applied part off the front of the contents
+for each edit, as execute did before, which is quadratic and so is
+only run with fewer inserts."""
+
+import os, sys, time, random, tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import metav.edit
+
+def sliced(edit_plan):
+    "Apply edit_plan, inserts only, the way execute did before"
+    filename = edit_plan[0][1][-1][1]
+    contents = open(filename).read()
+    pos = 0
+    rope = []
+    for p in sorted(edit_plan, key=metav.edit._sort_key):
+        begin_pos = p[1][-1][2]
+        to_copy = begin_pos - pos
+        rope.append(contents[:to_copy])
+        pos += to_copy
+        contents = contents[to_copy:]
+        rope.extend(["/*metav_generated:*/\n", str(p[2]),
+                     "\n/*:metav_generated*/"])
+    with open(filename + ".out", 'w') as fd:
+        for string in rope:
+            fd.write(string)
+        fd.write(contents)
+
+def plan(filename, size, inserts):
+    offsets = sorted(random.randrange(size) for i in range(inserts))
+    return [('insert', (('file', filename, o, 0, 0),), "wire w%d;" % i)
+            for i, o in enumerate(offsets)]
+
+def main(megabytes, inserts, old_inserts):
+    random.seed(1)
+    fd, filename = tempfile.mkstemp(suffix='.v')
+    line = "  assign a = b & c; // padding to make the file large\n"
+    size = megabytes * 1024 * 1024 // len(line) * len(line)
+    with os.fdopen(fd, 'w') as f:
+        f.write(line * (size // len(line)))
+    try:
+        print("%d MB file" % megabytes)
+        print("%-10s %10s %10s %12s" % ("engine", "inserts", "seconds",
+                                        "us/insert"))
+        for name, execute, n in (("sliced", sliced, old_inserts),
+                                 ("execute", metav.edit.execute, inserts)):
+            p = plan(filename, size, n)
+            start = time.perf_counter()
+            execute(p)
+            elapsed = time.perf_counter() - start
+            print("%-10s %10d %10.3f %12.2f" % (name, n, elapsed,
+                                                elapsed / n * 1e6))
+    finally:
+        os.remove(filename)
+        if os.path.exists(filename + ".out"):
+            os.remove(filename + ".out")
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--megabytes", type=int, default=20,
+                        help="size of the file")
+    parser.add_argument("--inserts", type=int, default=100000,
+                        help="inserts for execute")
+    parser.add_argument("--old-inserts", type=int, default=2000,
+                        help="inserts for the old way")
+    args = parser.parse_args()
+    main(args.megabytes, args.inserts, args.old_inserts)
@@ -0,0 +1,45 @@
+#!/usr/bin/python3
+# This file is part of metav.
+
+# metav is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# metav is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with metav.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time per module lexer setup: building a lexer against cloning one"""
+
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import metav.lex
+
+def timeit(f, n):
+    "Return seconds per call of f, over n calls"
+    start = time.perf_counter()
+    for i in range(n):
+        f()
+    return (time.perf_counter() - start) / n
+
+def main(n):
+    build = timeit(metav.lex._build_lexer, n)
+    metav.lex.vLexer()
+    clone = timeit(metav.lex.vLexer, n)
+    print("%-8s %12.1f us/module" % ("build", build * 1e6))
+    print("%-8s %12.1f us/module" % ("clone", clone * 1e6))
+    print("%-8s %12.1fx" % ("speedup", build / clone))
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", type=int, default=1000,
+                        help="number of modules")
+    args = parser.parse_args()
+    main(args.n)
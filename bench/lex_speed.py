@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+# This file is part of metav.
+
+# metav is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# metav is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with metav.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tokens per second of metav.lex on a generated gate level netlist
+
+Lexes the preprocessed text with positions taken from anchors, from a
+sideband source map, and from the source map with the pos_stack of
+every token looked up."""
+
+import os, sys, time, tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from metav.preproc import preproc
+from metav.lex import vLexer
+from metav.sourcemap import SourceMap
+
+LINE = '  nand2 u%(n)d (.a(n%(a)d), .b(n%(b)d), .y(n%(n)d)); // cell %(n)d\n'
+
+def netlist(lines):
+    "Return a generated module of lines lines"
+    parts = ["module net;\n"]
+    for n in range(lines - 2):
+        parts.append(LINE % {'n': n, 'a': n // 2, 'b': n // 3})
+    parts.append("endmodule\n")
+    return ''.join(parts)
+
+def run(filename, sideband, positions):
+    "Return (tokens, seconds) for lexing filename"
+    sourcemap = SourceMap() if sideband else None
+    text = preproc(filename, state={'sourcemap': sourcemap})[0]
+    lexer = vLexer(sourcemap)
+    lexer.input(text)
+    tokens = 0
+    start = time.perf_counter()
+    for t in iter(lexer.token, None):
+        if positions:
+            t.pos_stack
+        tokens += 1
+    return tokens, time.perf_counter() - start
+
+def main(lines):
+    fd, filename = tempfile.mkstemp(suffix='.v')
+    with os.fdopen(fd, 'w') as f:
+        f.write(netlist(lines))
+    try:
+        print("%d lines" % lines)
+        print("%-22s %10s %10s %12s" % ("mode", "tokens", "seconds", "tokens/s"))
+        for name, sideband, positions in (("anchors", False, False),
+                                          ("sideband", True, False),
+                                          ("sideband+positions", True, True)):
+            tokens, elapsed = run(filename, sideband, positions)
+            print("%-22s %10d %10.2f %12.0f" % (name, tokens, elapsed,
+                                                 tokens / elapsed))
+    finally:
+        os.remove(filename)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=1000000,
+                        help="lines in the netlist")
+    args = parser.parse_args()
+    main(args.lines)
@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+# This file is part of metav.
+
+# metav is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# metav is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with metav.  If not, see <http://www.gnu.org/licenses/>.
+
+"""File system calls made looking up modules in a long module path
+
+Spreads generated module files over many directories, and looks each
+up a number of times, as instantiations do, by trying each directory
+in turn and with metav.modpath.ModPath. Calls to os.stat, which
+os.path.isfile makes, and os.scandir are counted."""
+
+import os, sys, time, shutil, tempfile, random
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from metav.modpath import ModPath
+
+def try_each(modulename, modpath):
+    "Find the file the way process.py did before the index"
+    if "." not in modulename:
+        modulename += ".v"
+    for p in modpath:
+        filename = os.path.join(p, modulename)
+        if os.path.isfile(filename):
+            return filename
+    raise IOError("Could not find " + modulename)
+
+class Counted(object):
+    "Counts the calls of os.stat and os.scandir while in use"
+    def __enter__(self):
+        self.calls = 0
+        self.stat, self.scandir = os.stat, os.scandir
+        def stat(*args, **kwargs):
+            self.calls += 1
+            return self.stat(*args, **kwargs)
+        def scandir(*args, **kwargs):
+            self.calls += 1
+            return self.scandir(*args, **kwargs)
+        os.stat, os.scandir = stat, scandir
+        return self
+    def __exit__(self, *exc):
+        os.stat, os.scandir = self.stat, self.scandir
+
+def main(dirs, modules, lookups):
+    directory = tempfile.mkdtemp()
+    try:
+        modpath = []
+        names = []
+        for d in range(dirs):
+            p = os.path.join(directory, "lib%d" % d)
+            os.mkdir(p)
+            modpath.append(p)
+            for m in range(modules):
+                name = "m%d_%d" % (d, m)
+                open(os.path.join(p, name + ".v"), 'w').close()
+                names.append(name)
+        random.seed(1)
+        wanted = [random.choice(names) for i in range(lookups)]
+        print("%d directories of %d modules, %d lookups" % (dirs, modules,
+                                                            lookups))
+        print("%-10s %10s %10s" % ("lookup", "calls", "seconds"))
+        with Counted() as c:
+            start = time.perf_counter()
+            found = [try_each(name, modpath) for name in wanted]
+            elapsed = time.perf_counter() - start
+        print("%-10s %10d %10.3f" % ("try each", c.calls, elapsed))
+        with Counted() as c:
+            start = time.perf_counter()
+            index = ModPath(modpath)
+            indexed = [index.find(name) for name in wanted]
+            elapsed = time.perf_counter() - start
+        print("%-10s %10d %10.3f" % ("ModPath", c.calls, elapsed))
+        assert found == indexed
+        with Counted() as c:
+            index.refresh()
+        print("%-10s %10d" % ("refresh", c.calls))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dirs", type=int, default=40,
+                        help="directories in the module path")
+    parser.add_argument("--modules", type=int, default=50,
+                        help="module files in each directory")
+    parser.add_argument("--lookups", type=int, default=10000,
+                        help="modules looked up")
+    args = parser.parse_args()
+    main(args.dirs, args.modules, args.lookups)
@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+# This file is part of metav.
+
+# metav is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# metav is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with metav.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time parsing modules of 1k, 10k and 100k module items"""
+
+import os, sys, time, tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from metav.preproc import preproc
+from metav.lex import vLexer
+from metav.parse import vParser
+from metav.sourcemap import SourceMap
+
+ITEM = '''  wire w%(n)d;
+  assign w%(n)d = a ^ b;
+'''
+
+def module(items):
+    "Return a module with items module items"
+    parts = ["module net(a, b);\n  input a, b;\n"]
+    for n in range(items // 2):
+        parts.append(ITEM % {'n': n})
+    parts.append("endmodule\n")
+    return ''.join(parts)
+
+def main(sizes):
+    print("%10s %10s %12s" % ("items", "seconds", "us/item"))
+    prev = None
+    for items in sizes:
+        fd, filename = tempfile.mkstemp(suffix='.v')
+        with os.fdopen(fd, 'w') as f:
+            f.write(module(items))
+        try:
+            sourcemap = SourceMap()
+            text = preproc(filename, state={'sourcemap': sourcemap})[0]
+            start = time.perf_counter()
+            modules = vParser().parse(input=text, lexer=vLexer(sourcemap))
+            elapsed = time.perf_counter() - start
+        finally:
+            os.remove(filename)
+        assert len(modules[0].items) >= items
+        line = "%10d %10.3f %12.2f" % (items, elapsed, elapsed / items * 1e6)
+        if prev:
+            # For linear scaling, time per item stays constant
+            line += "   x%.2f time/item" % ((elapsed / items) / (prev[1] / prev[0]))
+        print(line)
+        prev = (items, elapsed)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("sizes", metavar="ITEMS", type=int, nargs="*",
+                        default=[1000, 10000, 100000],
+                        help="module items per module")
+    args = parser.parse_args()
+    main(args.sizes)
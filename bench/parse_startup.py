@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+# This file is part of metav.
+
+# metav is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# metav is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with metav.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time vParser() startup with cold and warm parse table caches
+
+Each start is timed in a fresh interpreter, so nothing is shared
+through the process but the cache directory."""
+
+import os, sys, shutil, subprocess, tempfile
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+CHILD = '''
+import sys, time
+sys.path.insert(0, %r)
+import metav.parse
+start = time.perf_counter()
+metav.parse.vParser(cache_dir=%r)
+first = time.perf_counter() - start
+start = time.perf_counter()
+metav.parse.vParser(cache_dir=%r)
+print(first, time.perf_counter() - start)
+'''
+
+def start(cache_dir):
+    "Return seconds for the first and second vParser() in a new process"
+    out = subprocess.run([sys.executable, '-c', CHILD % (ROOT, cache_dir, cache_dir)],
+                         stdout=subprocess.PIPE, check=True,
+                         universal_newlines=True).stdout
+    return [float(x) for x in out.split()[-2:]]
+
+def main(runs):
+    print("%-10s %12s %12s" % ("start", "vParser() s", "again s"))
+    for i in range(runs):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            print("%-10s %12.4f %12.6f" % (("cold",) + tuple(start(cache_dir))))
+            print("%-10s %12.4f %12.6f" % (("warm",) + tuple(start(cache_dir))))
+        finally:
+            shutil.rmtree(cache_dir)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=3,
+                        help="number of cold and warm starts")
+    args = parser.parse_args()
+    main(args.runs)
@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+# This file is part of metav.
+
+# metav is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# metav is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with metav.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time metav.preproc on a file where 90% of the code is inside a
+disabled `ifdef, compared to the same file with everything enabled"""
+
+import os, sys, time, tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from metav.preproc import preproc
+
+ENABLED = "   assign o%(n)d = a%(n)d / b%(n)d; // enabled\n"
+DISABLED = '''   initial begin : sim%(n)d
+      $display("%%m: `W = %%d", `W); /* simulation only */
+      `ifdef VERBOSE $display("t=%%t", $time); `endif
+      x%(n)d = y%(n)d / z%(n)d;
+   end
+'''
+
+def netlist(blocks):
+    "Return a module where nine lines out of ten are simulation only"
+    parts = ["`define W 8\nmodule net;\n"]
+    for n in range(blocks):
+        parts.append(ENABLED % {'n': n})
+        parts.append("`ifdef SIMULATION\n")
+        for i in range(2):
+            parts.append(DISABLED % {'n': n * 2 + i})
+        parts.append("`endif\n")
+    parts.append("endmodule\n")
+    return ''.join(parts)
+
+def run(filename, defines):
+    start = time.perf_counter()
+    text, _, _ = preproc(filename, state={'defines': defines})
+    return time.perf_counter() - start, len(text)
+
+def main(blocks):
+    fd, filename = tempfile.mkstemp(suffix='.v')
+    with os.fdopen(fd, 'w') as f:
+        f.write(netlist(blocks))
+    try:
+        size = os.path.getsize(filename)
+        print("input: %d bytes" % size)
+        for name, defines in (("disabled", {}),
+                              ("enabled", {'SIMULATION': '1'})):
+            elapsed, out = run(filename, defines)
+            print("%-9s %8.4f s %8.2f MB/s  output %d bytes" %
+                  (name, elapsed, size / elapsed / 1e6, out))
+    finally:
+        os.remove(filename)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--blocks", type=int, default=50000)
+    args = parser.parse_args()
+    main(args.blocks)
@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+# This file is part of metav.
+
+# metav is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# metav is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with metav.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compare peak memory of preprocessing a large file with many
+includes the way it was done before streaming, collected in memory,
+streamed to a file, and lexed from the whole text and as it comes"""
+
+import os, re, sys, shutil, tempfile, tracemalloc
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from metav.preproc import preproc, preproc_iter, IncludeCache
+from metav.sourcemap import SourceMap
+from metav.lex import vLexer, feed
+
+# How preproc was before it streamed its text: each file is built as
+# one string with +=, and included files are pasted into it. Only the
+# rules the generated files need are kept, and the text is matched at
+# an offset, as the old slicing of what is left is quadratic
+_old_rules = [(re.compile(r), a) for r, a in (
+    (r'//[^\n]*', None),
+    (r'/\*(.|\n)*?\*/', None),
+    (r'"(\\"|[^"])*"', None),
+    (r'`include\s+"([^"]+)"', 'include'),
+    (r'(.|\n)([^/`":]|\n)*', None))]
+
+def old_preproc(filename, incpath):
+    cont = open(filename).read()
+    return "`file(%s)" % filename + _old_process(cont, incpath) + \
+        "`endfile(%s)" % filename
+
+def _old_process(cont, incpath):
+    ret = ""
+    pos = 0
+    while pos < len(cont):
+        for regex, action in _old_rules:
+            m = regex.match(cont, pos)
+            if m:
+                break
+        gen = m.group(0)
+        if action == 'include':
+            gen = old_preproc(os.path.join(incpath, m.group(1)), incpath)
+        ret += gen
+        pos = m.end()
+    return ret
+
+LINE = "   wire [7:0] n%d = a%d / b%d; // net\n"
+
+def make_tree(directory, includes, lines):
+    "Write top.v including includes headers of lines lines each"
+    top = ["module top;\n"]
+    for i in range(includes):
+        name = "inc%d.vh" % i
+        with open(os.path.join(directory, name), 'w') as f:
+            f.write(''.join(LINE % (n, n, n) for n in range(lines)))
+        top.append('`include "%s"\n' % name)
+    top.append("endmodule\n")
+    filename = os.path.join(directory, "top.v")
+    with open(filename, 'w') as f:
+        f.write(''.join(top))
+    return filename
+
+def peak(f):
+    tracemalloc.start()
+    try:
+        f()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def main(includes, lines):
+    directory = tempfile.mkdtemp()
+    try:
+        top = make_tree(directory, includes, lines)
+        # A cache of its own for each, so that none is filled already
+        def state(sourcemap=None):
+            return {'incpath': (directory,), 'include_cache': IncludeCache(),
+                    'sourcemap': sourcemap}
+        source = sum(os.path.getsize(os.path.join(directory, f))
+                     for f in os.listdir(directory))
+        def before():
+            old_preproc(top, directory)
+        def in_memory():
+            preproc(top, state())
+        def streaming():
+            with open(os.path.join(directory, "top.out"), 'w') as out:
+                preproc(top, state(), out=out)
+        def lex(token):
+            while token() is not None:
+                pass
+        def lex_text():
+            sourcemap = SourceMap()
+            lexer = vLexer(sourcemap)
+            lexer.input(preproc(top, state(sourcemap))[0])
+            lex(lexer.token)
+        def lex_streamed():
+            sourcemap = SourceMap()
+            lex(feed(vLexer(sourcemap), preproc_iter(top, state(sourcemap))[0]))
+        vLexer()
+        print("source: %d bytes in %d files" % (source, includes + 1))
+        for name, f in (("before", before), ("in memory", in_memory),
+                        ("streaming", streaming), ("lex text", lex_text),
+                        ("lex stream", lex_streamed)):
+            p = peak(f)
+            print("%-10s peak %12d bytes  %6.2f x source" % (name, p, p / source))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--includes", type=int, default=50)
+    parser.add_argument("--lines", type=int, default=2000)
+    args = parser.parse_args()
+    main(args.includes, args.lines)
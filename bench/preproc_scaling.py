@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+# This file is part of metav.
+
+# metav is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# metav is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with metav.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time metav.preproc on generated netlists from 1 KB to 50 MB"""
+
+import os, sys, time, tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from metav.preproc import preproc
+
+CHUNK = '''   // net %(n)d
+   wire [`W-1:0] n%(n)d = a%(n)d / b%(n)d; /* divide */
+   assign o%(n)d = {n%(n)d[3:0], "str: %(n)d"};
+'''
+
+def netlist(size):
+    "Return a generated module of roughly size characters"
+    parts = ["`define W 8\nmodule net;\n"]
+    total = len(parts[0])
+    n = 0
+    while total < size:
+        s = CHUNK % {'n': n}
+        parts.append(s)
+        total += len(s)
+        n += 1
+    parts.append("endmodule\n")
+    return ''.join(parts)
+
+def main(sizes):
+    print("%10s %10s %10s" % ("size", "seconds", "MB/s"))
+    prev = None
+    for size in sizes:
+        fd, filename = tempfile.mkstemp(suffix='.v')
+        with os.fdopen(fd, 'w') as f:
+            f.write(netlist(size))
+        try:
+            start = time.perf_counter()
+            preproc(filename, state={})
+            elapsed = time.perf_counter() - start
+        finally:
+            os.remove(filename)
+        line = "%10d %10.4f %10.2f" % (size, elapsed, size / elapsed / 1e6)
+        if prev:
+            # For linear scaling, time per byte stays constant
+            line += "   x%.2f time/byte" % ((elapsed / size) / (prev[1] / prev[0]))
+        print(line)
+        prev = (size, elapsed)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--max-size", type=int, default=50*1000*1000,
+                        help="largest input size in characters")
+    args = parser.parse_args()
+    sizes = [s for s in (1000, 10*1000, 100*1000, 1000*1000,
+                         10*1000*1000, 50*1000*1000) if s <= args.max_size]
+    main(sizes)
@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+# This file is part of metav.
+
+# metav is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# metav is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with metav.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Parse the test corpus from many threads, and check that every
+result is the same as when parsed in one thread"""
+
+import os, sys, glob, time
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from process import parse_files
+import metav.vast
+import ply.lex
+
+def signature(x, seen=None):
+    "Return a string describing the AST x, positions and all"
+    if seen is None:
+        seen = set()
+    if isinstance(x, (str, int, float, bool, type(None))):
+        return repr(x)
+    if isinstance(x, ply.lex.LexToken):
+        return 'T(%s,%r,%r)' % (x.type, str(x.value), x.pos_stack)
+    if isinstance(x, (list, tuple)):
+        return '[%s]' % ','.join(signature(y, seen) for y in x)
+    if isinstance(x, (set, frozenset)):
+        return '{%s}' % ','.join(sorted(repr(y) for y in x))
+    if isinstance(x, dict):
+        return '{%s}' % ','.join('%s:%s' % (k, signature(x[k], seen))
+                                 for k in sorted(x))
+    if id(x) in seen:
+        return '@' + type(x).__name__
+    seen.add(id(x))
+    if hasattr(x, 'co_code'):
+        return type(x).__name__
+    # Nodes keep most of their attributes in slots, and their position
+    # as a span in a source map, which pos looks up
+    state = dict(getattr(x, '__dict__', {}))
+    if isinstance(x, metav.vast.Ast):
+        state.update(metav.vast._slots(x))
+        state.pop('_sourcemap', None)
+        if state.pop('_span', None) is not None:
+            state['pos'] = x.pos
+    state.pop('code', None)
+    if not state:
+        return type(x).__name__
+    return '%s(%s)' % (type(x).__name__, ','.join(
+        '%s=%s' % (k, signature(state[k], seen)) for k in sorted(state)))
+
+def main(threads, rounds):
+    # Switch threads often, to make races show up with a GIL too
+    sys.setswitchinterval(1e-6)
+    corpus = sorted(glob.glob(os.path.join(ROOT, 'test', '*.v')))
+    incpath = [os.path.join(ROOT, 'test', 'include'), os.path.join(ROOT, 'test')]
+    expected = [signature(m) for m in parse_files(corpus, incpath, threads=1)]
+    start = time.perf_counter()
+    results = parse_files(corpus * rounds, incpath, threads=threads)
+    elapsed = time.perf_counter() - start
+    bad = [f for f, r, e in zip(corpus * rounds, results, expected * rounds)
+           if signature(r) != e]
+    print("%d parses in %d threads, %.2fs, %d differed" % (
+        len(results), threads, elapsed, len(bad)))
+    for f in sorted(set(bad)):
+        print("  differed: %s" % f)
+    return not bad
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=32,
+                        help="number of threads")
+    parser.add_argument("--rounds", type=int, default=50,
+                        help="times to parse the corpus")
+    args = parser.parse_args()
+    sys.exit(0 if main(args.threads, args.rounds) else 1)
@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+# This file is part of metav.
+
+# metav is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# metav is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with metav.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time counting the nodes of a large design
+
+Counts the nodes of a generated module with metav.vast.walk and with a
+recursive function, as scripts had to before, and the identifiers
+with a NodeVisitor. Then does the same for an expression nested deeper
+than the recursion limit."""
+
+import os, sys, time, tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from metav.preproc import preproc
+from metav.parse import parse
+from metav.sourcemap import SourceMap
+import metav.vast as ast
+
+def design(lines):
+    "Return the text of a module of about lines lines"
+    text = ["module top (clk, a, b);", "  input clk, a, b;"]
+    for i in range(lines // 6):
+        text.append("  wire [7:0] w%d;" % i)
+        text.append("  reg [7:0] r%d;" % i)
+        text.append("  assign w%d = (a & r%d) | {b, w%d[2], r%d[3:0]};" %
+                    (i, i, i // 2, i // 3))
+        text.append("  always @(posedge clk)")
+        text.append("    if (a) r%d <= w%d + 1; else r%d <= r%d - w%d;" %
+                    (i, i, i, i, i // 2))
+        text.append("  sub u%d (.x(w%d), .y(a));" % (i, i))
+    text.append("endmodule")
+    return '\n'.join(text) + '\n'
+
+def recursive(node):
+    "Count the nodes the way a script would have"
+    n = 1
+    for child in ast.iter_children(node):
+        n += recursive(child)
+    return n
+
+class Counter(ast.NodeVisitor):
+    def __init__(self):
+        self.ids = 0
+    def visit_Id(self, node):
+        self.ids += 1
+
+def chain(depth):
+    "Return a + a + ... + a with depth additions"
+    e = ast.Id("a")
+    for i in range(depth):
+        e = ast.BinaryOp(e, '+', ast.Id("a"))
+    return e
+
+def visited(node):
+    counter = Counter()
+    counter.visit(node)
+    return "%d ids" % counter.ids
+
+def time_all(node):
+    results = []
+    for name, count in (("walk", lambda: sum(1 for n in ast.walk(node))),
+                        ("NodeVisitor", lambda: visited(node)),
+                        ("recursive", lambda: recursive(node))):
+        start = time.perf_counter()
+        try:
+            n = count()
+        except RecursionError:
+            n = "RecursionError"
+        results.append((name, n, time.perf_counter() - start))
+    return results
+
+def main(lines, depth):
+    fd, filename = tempfile.mkstemp(suffix='.v')
+    with os.fdopen(fd, 'w') as f:
+        f.write(design(lines))
+    try:
+        sourcemap = SourceMap()
+        module = parse(preproc(filename, state={'sourcemap': sourcemap})[0],
+                       sourcemap)[0]
+    finally:
+        os.remove(filename)
+    print("%-16s %-12s %14s %10s %10s" % ("tree", "way", "counted",
+                                          "seconds", "ns/node"))
+    for tree, node in (("%d lines" % lines, module),
+                       ("%d deep" % depth, chain(depth))):
+        nodes = sum(1 for n in ast.walk(node))
+        for name, n, elapsed in time_all(node):
+            print("%-16s %-12s %14s %10.3f %10.0f" % (tree, name, n, elapsed,
+                                                      elapsed / nodes * 1e9))
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=30000,
+                        help="lines in the module")
+    parser.add_argument("--depth", type=int, default=100000,
+                        help="nesting of the deep expression")
+    args = parser.parse_args()
+    main(args.lines, args.depth)
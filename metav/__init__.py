@@ -13,4 +13,6 @@
 # You should have received a copy of the GNU General Public License
 # along with metav.  If not, see <http://www.gnu.org/licenses/>.
 
-__all__ = ['lex', 'literal', 'parse', 'preproc', 'vast', 'edit']
+__all__ = ['lex', 'literal', 'parse', 'preproc', 'sourcemap', 'vast', 'edit',
+           'astcache', 'design', 'daemon',
+           'manifest', 'modpath', 'stats']
@@ -0,0 +1,119 @@
+# This file is part of metav.
+
+# metav is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# metav is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with metav.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Cache of parsed modules on disk"""
+
+import os
+import pickle
+import hashlib
+import threading
+from . import parse
+from . import stats
+
+class AstCache(object):
+    """Parsed modules pickled in directory, by a hash of the grammar and
+    of what they were parsed from
+
+    When the files add up to more than max_size bytes, the least
+    recently used ones are removed."""
+    # Change when the pickled AST changes
+    version = 2
+
+    def __init__(self, directory, max_size=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, text, sourcemap):
+        "Return the key for text preprocessed with sourcemap"
+        h = hashlib.sha256()
+        h.update(repr((self.version, parse._grammar_hash(),
+                       sourcemap.contexts,
+                       sorted(sourcemap.sources.items()))).encode())
+        for a in (sourcemap.starts, sourcemap.offsets, sourcemap.ctxs):
+            h.update(a.tobytes())
+        # Lines and columns are counted in the files, which can change
+        # where the text does not, as in disabled `ifdefs
+        for name in sorted(set(c[3] for c in sourcemap.contexts
+                               if c[2] == 'file')):
+            with open(name, 'rb') as f:
+                h.update(hashlib.sha256(f.read()).digest())
+        h.update(text.encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, 'ast-%s.pickle' % key)
+
+    def load(self, key):
+        "Return the modules stored for key, or None"
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                modules = pickle.load(f)
+        except FileNotFoundError:
+            self.misses += 1
+            stats.count('ast_cache_misses')
+            return None
+        except Exception as e:
+            print("Removing unreadable AST cache file %s: %r" % (path, e))
+            self.misses += 1
+            stats.count('ast_cache_misses')
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        # The modification time tells which files were used last
+        os.utime(path)
+        self.hits += 1
+        stats.count('ast_cache_hits')
+        return modules
+
+    def store(self, key, modules):
+        "Store modules for key. Gives up quietly if they can't be stored"
+        path = self._path(key)
+        tmp = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp, 'wb') as f:
+                pickle.dump(modules, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except (OSError, pickle.PicklingError, RecursionError) as e:
+            print("Could not store %s in AST cache: %r" % (path, e))
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('ast-') and entry.name.endswith('.pickle'):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
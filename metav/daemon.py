@@ -0,0 +1,145 @@
+# This file is part of metav.
+
+# metav is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# metav is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with metav.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A process keeping a design in memory, taking requests on a UNIX socket
+
+Requests and replies are JSON objects, one per line:
+
+  {"command": "process", "tops": [...], "noop": false}
+      -> {"results": [[top, edits, seconds, error], ...]}
+  {"command": "status"}
+      -> {"modules": [...], "files": n, "parsed": n, "watched": [...]}
+  {"command": "shutdown"}
+      -> {}
+"""
+
+import os
+import json
+import time
+import socket
+import traceback
+import socketserver
+from . import edit
+from . import modpath
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        try:
+            reply = self.server.command(json.loads(line.decode()))
+        except Exception:
+            reply = {'error': traceback.format_exc()}
+        self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+class Server(socketserver.UnixStreamServer):
+    """Serves requests for the modules of design, a metav.design.Design,
+    on the UNIX socket path
+
+    Every interval seconds, and before each request, the files the
+    design was parsed from are checked. If interval is given, the tops
+    processed so far are watched: when they or modules they use
+    change, they are processed again, and their edit plans executed
+    unless they were asked for with noop."""
+    def __init__(self, path, design, interval=None):
+        if os.path.exists(path):
+            # Left behind by a daemon that is gone, unless one answers
+            s = socket.socket(socket.AF_UNIX)
+            try:
+                s.connect(path)
+            except ConnectionRefusedError:
+                os.remove(path)
+            else:
+                raise IOError("A daemon is already serving " + path)
+            finally:
+                s.close()
+        socketserver.UnixStreamServer.__init__(self, path, _Handler)
+        self.path = path
+        self.design = design
+        self.timeout = interval
+        self.watched = {}
+        self.done = False
+
+    def serve(self):
+        "Handle requests until told to shut down"
+        last = time.monotonic()
+        try:
+            while not self.done:
+                # Returns after timeout seconds without a request
+                self.handle_request()
+                if self.timeout is not None and \
+                   time.monotonic() - last >= self.timeout:
+                    self.poll()
+                    last = time.monotonic()
+        finally:
+            self.server_close()
+            os.remove(self.path)
+
+    def poll(self):
+        "Forget what changed, and process the watched tops it affected again"
+        modpath.refresh()
+        gone = self.design.refresh()
+        results = []
+        if self.timeout is not None:
+            for top in sorted(self.watched):
+                if top in gone:
+                    results.append(self.process(top, self.watched[top]))
+        return results
+
+    def process(self, top, noop):
+        "Return [top, edits, seconds, error] for processing top"
+        start = time.perf_counter()
+        try:
+            module = self.design.get_module(top)
+            if not noop:
+                edit.execute(module.edit_plan)
+            result = [top, len(module.edit_plan), None]
+        except Exception:
+            result = [top, 0, traceback.format_exc()]
+        if self.timeout is not None:
+            self.watched[top] = noop
+        result.insert(2, time.perf_counter() - start)
+        return result
+
+    def command(self, request):
+        "Return the reply to request"
+        command = request['command']
+        if command == 'process':
+            self.poll()
+            return {'results': [self.process(top, request.get('noop', False))
+                                for top in request['tops']]}
+        if command == 'status':
+            return {'modules': sorted(self.design.modules),
+                    'files': len(self.design.files),
+                    'parsed': self.design.parsed,
+                    'watched': sorted(self.watched)}
+        if command == 'shutdown':
+            self.done = True
+            return {}
+        raise ValueError("Unknown command %r" % (command, ))
+
+def request(path, message):
+    "Send message to the daemon on path, and return its reply"
+    s = socket.socket(socket.AF_UNIX)
+    try:
+        s.connect(path)
+        s.sendall(json.dumps(message).encode() + b'\n')
+        f = s.makefile('rb')
+        reply = json.loads(f.readline().decode())
+        f.close()
+    finally:
+        s.close()
+    if 'error' in reply:
+        raise RuntimeError("metav daemon failed:\n" + reply['error'])
+    return reply
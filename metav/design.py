@@ -0,0 +1,212 @@
+# This file is part of metav.
+
+# metav is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# metav is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with metav.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The modules of a design, parsed again only when their inputs change"""
+
+import os
+import json
+import pickle
+import sqlite3
+from . import parse
+from . import vast
+from .preproc import preproc
+from .sourcemap import SourceMap
+from . import modpath as _modpath
+from . import stats
+
+class Design(object):
+    """A table of the modules of a design
+
+    For each file parsed it keeps the parsed modules, the size and
+    modification time of the file and of the files it includes, and
+    the values of the defines in defines that it looked at. A file is
+    preprocessed and parsed again only when one of those changed.
+
+    If database is the name of an SQLite file, the table is kept in
+    it, so that it outlives the process.
+
+    Processed modules, with their metav code executed, are kept in
+    modules until refresh() finds that they, or modules they
+    instantiate, are stale."""
+    # Change when what is stored changes
+    version = 2
+
+    def __init__(self, modpath=('.',), incpath=('.',), defines=None,
+                 database=None, debug=False):
+        self.modpath = _modpath.index(modpath)
+        self._generation = self.modpath.generation
+        self.incpath = incpath
+        self.defines = dict(defines or {})
+        self.debug = debug
+        self.files = {}
+        self.modules = {}
+        self.parsed = 0
+        self._module_files = {}
+        self._users = {}
+        self.db = None
+        if database is not None:
+            self._open(database)
+
+    def _open(self, database):
+        self.db = sqlite3.connect(database, timeout=60)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta "
+                            "(key TEXT PRIMARY KEY, value TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS files "
+                            "(filename TEXT PRIMARY KEY, stamps TEXT, "
+                            "uses TEXT, data BLOB)")
+            version = "%d %s" % (self.version, parse._grammar_hash())
+            row = self.db.execute("SELECT value FROM meta WHERE key = "
+                                  "'version'").fetchone()
+            if row is None or row[0] != version:
+                self.db.execute("DELETE FROM files")
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES "
+                                "('version', ?)", (version, ))
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def find_file(self, name):
+        "Return the file in modpath with module name"
+        return self.modpath.find(name)
+
+    def _fresh(self, entry):
+        for name, value in entry['uses'].items():
+            if self.defines.get(name) != value:
+                return False
+        for p, mtime, size in entry['stamps']:
+            try:
+                st = os.stat(p)
+            except OSError:
+                return False
+            if st.st_mtime_ns != mtime or st.st_size != size:
+                return False
+        return True
+
+    def _lookup(self, filename):
+        entry = self.files.get(filename)
+        if entry is None and self.db is not None:
+            row = self.db.execute("SELECT stamps, uses, data FROM files "
+                                  "WHERE filename = ?", (filename, )).fetchone()
+            if row is not None:
+                entry = {'stamps': [tuple(s) for s in json.loads(row[0])],
+                         'uses': json.loads(row[1]),
+                         'data': row[2]}
+        if entry is not None and self._fresh(entry):
+            self.files[filename] = entry
+            return entry
+        return None
+
+    def _parse(self, filename):
+        "Preprocess and parse filename, and add it to the table"
+        st = os.stat(filename)
+        scope = {'uses': {}, 'defines': {}, 'guards': {},
+                 'stamps': [(filename, st.st_mtime_ns, st.st_size)]}
+        sourcemap = SourceMap()
+        p, edit_plan, includes = preproc(filename, state = {
+                'incpath': self.incpath,
+                'defines': dict(self.defines),
+                'include_scopes': [scope],
+                'sourcemap': sourcemap})
+        modules = parse.parse(p, sourcemap, debug=self.debug)
+        self.parsed += 1
+        entry = {'stamps': scope['stamps'],
+                 'uses': scope['uses'],
+                 'data': pickle.dumps((modules, edit_plan, includes),
+                                      pickle.HIGHEST_PROTOCOL)}
+        self.files[filename] = entry
+        if self.db is not None:
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO files VALUES "
+                                "(?, ?, ?, ?)",
+                                (filename, json.dumps(entry['stamps']),
+                                 json.dumps(entry['uses']), entry['data']))
+        return entry
+
+    def get_module(self, name):
+        "Return module name processed, parsing it only if it is stale"
+        return self._get_module(name, None)
+
+    def _get_module(self, name, user):
+        if user is not None:
+            self._users.setdefault(name, set()).add(user)
+        if name in self.modules:
+            stats.count('module_cache_hits')
+            return self.modules[name]
+        stats.count('module_cache_misses')
+        filename = self.find_file(name)
+        entry = self._lookup(filename)
+        if entry is None:
+            stats.count('design_table_misses')
+            entry = self._parse(filename)
+        else:
+            stats.count('design_table_hits')
+        # A copy of its own, as executing metav changes it
+        modules, edit_plan, includes = pickle.loads(entry['data'])
+        def get_module(iname):
+            return self._get_module(iname, name)
+        for module in modules:
+            if not name.startswith(module.name.value):
+                continue
+            self.modules[name] = module
+            self._module_files[name] = filename
+            module.files = list(entry['stamps'])
+            for iname in module.insts:
+                inst = module.insts[iname]
+                assert isinstance(inst, vast.ModuleInsts)
+                inst._get_module = get_module
+            module.edit_plan = edit_plan
+            module.execute_metav(get_module, includes)
+            return module
+        raise IOError("No module %s in %s" % (name, filename))
+
+    def invalidate(self, name):
+        "Forget module name processed, and the modules that used it"
+        if self.modules.pop(name, None) is None:
+            return set()
+        gone = set([name])
+        for user in self._users.pop(name, ()):
+            gone |= self.invalidate(user)
+        return gone
+
+    def refresh(self):
+        """Forget the files that changed, and the processed modules
+        from them, found in another file in modpath now, or using them.
+        Returns the names of those modules"""
+        gone = set()
+        # The index is shared, and may have been refreshed by others
+        self.modpath.refresh()
+        if self.modpath.generation != self._generation:
+            self._generation = self.modpath.generation
+            # A new file may hide the one a module was found in
+            for name, filename in list(self._module_files.items()):
+                try:
+                    found = self.modpath.find(name)
+                except IOError:
+                    found = None
+                if found != filename:
+                    del self._module_files[name]
+                    gone |= self.invalidate(name)
+        stale = set(filename for filename, entry in self.files.items()
+                    if not self._fresh(entry))
+        for filename in stale:
+            del self.files[filename]
+        for name, filename in list(self._module_files.items()):
+            if filename in stale:
+                del self._module_files[name]
+                gone |= self.invalidate(name)
+        return gone
@@ -15,64 +15,62 @@
 
 """Code for executing an edit plan"""
 
+from . import stats
+
 def _sort_key(p):
     pos = p[1][-1]
     # return filename, charno
     return pos[1], pos[2]
 
-def execute(edit_plan):
-    file = None
-    rope = [] # A array of strings to be concatenated
-    filename = None
-    for p in sorted(edit_plan, key=_sort_key):
-        print(p)
-        instruction, position_stack = p[0:2]
-        start_position = position_stack[-1]
-        begin_type, begin_file, begin_pos = start_position[0:3]
-        assert begin_type == "file"
-        if filename != begin_file:
-            if filename:
-                # Flush data
-                fd = open(filename+".out", 'w')
-                for string in rope:
-                    fd.write(string)
-                fd.write(file['contents'])
-                fd.close()
-            filename = begin_file
-            file = {'contents': open(filename).read(),
-                    'pos': 0,}
-            rope = []
-        assert begin_pos >= file['pos'], "begin_pos (%d) < file['pos'] (%d)" % (begin_pos, file['pos'])
-
-        if begin_pos > file['pos']:
-            to_copy = begin_pos - file['pos']
-            rope.append(file['contents'][:to_copy])
-            file['pos'] += to_copy
-            file['contents'] = file['contents'][to_copy:]
-
-        assert begin_pos == file['pos']
-        print("At %d" % begin_pos)
+def execute(edit_plan, verbose=False):
+    """Write each file edit_plan changes, with the changes, to the file
+    name with .out added
 
-        if instruction in ("remove", "delete"):
-            end   = p[2][-1]
-            assert end[0] == 'file'
-            assert end[1] == filename
-            end   = end[2]
-            assert begin_pos < end
-
-            to_skip = end - begin_pos
-            file['pos'] += to_skip
-            skipped = file['contents'][:to_skip]
-            file['contents'] = file['contents'][to_skip:]
+    Each file is read once, and written from pieces of it and of the
+    changes with one writelines. If verbose, the plan is printed."""
+    with stats.phase('edit'):
+        filename = None
+        for p in sorted(edit_plan, key=_sort_key):
+            if verbose:
+                print(p)
+            if p[1][-1][1] != filename:
+                if filename:
+                    _flush(filename, pieces, contents[pos:])
+                filename = p[1][-1][1]
+                with open(filename) as f:
+                    contents = f.read()
+                pos = 0
+                pieces = [] # Strings to be concatenated
+            pos = _apply(p, filename, contents, pos, pieces)
+        if filename:
+            _flush(filename, pieces, contents[pos:])
 
+def _apply(p, filename, contents, pos, pieces):
+    "Add the pieces for p from pos on, and return where contents goes on"
+    instruction, position_stack = p[0:2]
+    begin_type, begin_file, begin_pos = position_stack[-1][0:3]
+    assert begin_type == "file"
+    assert begin_pos >= pos, "begin_pos (%d) < pos (%d)" % (begin_pos, pos)
+    if begin_pos > pos:
+        pieces.append(contents[pos:begin_pos])
+    if instruction in ("remove", "delete"):
+        end   = p[2][-1]
+        assert end[0] == 'file'
+        assert end[1] == filename
+        end   = end[2]
+        assert begin_pos < end
         if instruction == "remove":
-            rope.extend(["/*metav_delete:", skipped, ":metav_delete*/"])
-        elif instruction == "delete":
-            pass
-        elif instruction == "insert":
-            insert = str(p[2])
-            rope.extend(["/*metav_generated:*/\n",
-                         insert,
-                         "\n/*:metav_generated*/"])
-        else:
-            assert False, "Unknown edit plan instruction, "+repr(instruction)
+            pieces.extend(["/*metav_delete:", contents[begin_pos:end],
+                           ":metav_delete*/"])
+        return end
+    elif instruction == "insert":
+        pieces.extend(["/*metav_generated:*/\n",
+                       str(p[2]),
+                       "\n/*:metav_generated*/"])
+        return begin_pos
+    assert False, "Unknown edit plan instruction, "+repr(instruction)
+
+def _flush(filename, pieces, rest):
+    pieces.append(rest)
+    with open(filename+".out", 'w') as fd:
+        fd.writelines(pieces)
@@ -16,7 +16,10 @@
 import re
 import ply.lex
 import copy
+import threading
+import functools
 from .literal import VerilogNumber, String
+from .sourcemap import SourceMap
 
 keywords = ('MODULE', 'ENDMODULE', 'INPUT', 'OUTPUT', 'REG', 'WIRE', 'INOUT',
             'ALWAYS', 'ASSIGN', 'POSEDGE', 'NEGEDGE', 'OR', 'CASE', 'CASEZ',
@@ -40,13 +43,138 @@ tokens = keywords + \
     'ID', 'SYS_ID', 'NUMBER', 'STRING', 'REAL', 'METAV',
     )
 
-def vLexer():
-    ## tuple of tuples:
-    # (postype, posvalue, pos, line, linepos)
-    # ('file', 'test.v', 0, 1, 0)
-    pos_stack = (('void', None, 0, 1, 0),)
-    lex_offset = 0
-    
+class _Token(ply.lex.LexToken):
+    """A token that looks up its position when it is asked for
+
+    pos_stack is a tuple of tuples:
+    (postype, posvalue, pos, line, linepos)
+    ('file', 'test.v', 0, 1, 0)"""
+    # Set with offset when positions come from anchors
+    ctx = None
+
+    @property
+    def location(self):
+        "(context, offset) of the token in the source map"
+        if self.ctx is None:
+            return self.lexer.sourcemap.locate(self.lexpos)
+        return self.ctx, self.offset
+
+    @functools.cached_property
+    def pos_stack(self):
+        return self.lexer.sourcemap.stack(*self.location)
+
+    def __getstate__(self):
+        # The lexer can't be pickled, so look up the position first
+        state = dict(self.__dict__)
+        state['pos_stack'] = self.pos_stack
+        del state['lexer']
+        return state
+
+_lexer = None
+_lexer_lock = threading.Lock()
+
+def vLexer(sourcemap=None):
+    """Return a lexer for the text from metav.preproc.preproc
+
+    If the text was made with a source map, pass it as sourcemap, and
+    positions are looked up there. Otherwise they are taken from the
+    anchors in the text.
+
+    The lexer is only built once. Each call returns a clone of it with
+    its own state, so lexers from different calls can be used in
+    different threads at the same time."""
+    global _lexer
+    with _lexer_lock:
+        if _lexer is None:
+            _lexer = _build_lexer()
+    lexer = _lexer.clone()
+    lexer.lineno = 1
+    lexer.anchored = sourcemap is None
+    lexer.sourcemap = SourceMap() if sourcemap is None else sourcemap
+    # The context being lexed, and its offset relative to lexpos, when
+    # following anchors. ctx_stack has those of the enclosing contexts
+    lexer.ctx = -1
+    lexer.delta = 0
+    lexer.ctx_stack = []
+    # Where the text given to input starts in the whole text, when it
+    # is fed a window at a time
+    lexer.base = 0
+    # For attaching comments to identifiers
+    lexer.prev_decl = None
+    lexer.block_comment = None
+    lexer.prev_id = None
+    return lexer
+
+# What a token can span lines in, or what may look like the start of
+# one: comments, strings, escaped identifiers and generated code. The
+# text is not cut inside them
+_unit = re.compile(r'//[^\n]*|\\\S+|"(?:\\"|[^"])*(?:"|\Z)|'
+                   r'/\*metav\ generated:\*/.*?(?:/\*end\ metav\ generated\*/|\Z)|'
+                   r'/\*.*?(?:\*/|\Z)', re.S)
+
+def _cut(text):
+    """Return the offset after the last newline in text where a token
+    can not go on past, or 0 if there is none"""
+    cut = 0
+    end = 0
+    for m in _unit.finditer(text):
+        n = text.rfind('\n', end, m.start())
+        if n >= 0:
+            cut = n + 1
+        if m.end() == len(text):
+            # It may go on in the text that comes after
+            return cut
+        end = m.end()
+    n = text.rfind('\n', end)
+    if n >= 0:
+        cut = n + 1
+    return cut
+
+def _window(rest, chunks, size):
+    """Return (text, rest), where text is rest and what follows from
+    chunks, at least size long unless they run out and cut where _cut
+    says, and rest what is left over"""
+    text = rest
+    for chunk in chunks:
+        # Grown in place, as there is no other reference to it after
+        # the first time
+        text += chunk
+        if len(text) >= size:
+            cut = _cut(text)
+            if cut:
+                return text[:cut], text[cut:]
+            # In something longer than the window
+            size = 2 * len(text)
+    return text, ''
+
+def feed(lexer, chunks, size=1 << 16):
+    """Return a function giving the tokens of the text in chunks, an
+    iterator over pieces of it, as lexer.token does for a text given
+    to lexer.input
+
+    The text is given to lexer a window of about size at a time, cut
+    between lines, so only that much of it is kept. Positions are
+    those in the whole text, so it must have been made with a source
+    map."""
+    assert not lexer.anchored, "Positions in a window need a source map"
+    chunks = iter(chunks)
+    rest = ''
+    lexer.input('')
+    def token():
+        nonlocal rest
+        while True:
+            tok = lexer.token()
+            if tok is not None:
+                return tok
+            lexer.base += lexer.lexlen
+            text, rest = _window(rest, chunks, size)
+            if not text:
+                return None
+            lexer.input(text)
+    return token
+
+def _build_lexer():
+    "Build the lexer vLexer clones. State is kept on the lexer, not here"
     def build_symbolre(symbols=symbols):
         single = ''
         rest = []
@@ -64,24 +192,16 @@ def vLexer():
     def TOKEN(r):
         def set_doc(f):
             def new_f(t):
-                nonlocal pos_stack, lex_offset
-                # Do book-keeping to correct the positions
-                l = pos_stack[-1]
-                diff = t.lexpos - l[2] - lex_offset
-                #assert diff >= 0, "diff=%d, should be >= 0" % diff
-                if diff > 0:
-                    pos_stack = pos_stack[:-1] + ((l[0], l[1], l[2]+diff, l[3], l[4]+diff),)
-                    #print("diff: " + repr(pos_stack))
-                t.pos_stack = pos_stack[1:]
-                ret = f(t)
-                # Count linenumbers
-                v = str(t.value)
-                if '\n' in v:
-                    l = pos_stack[-1]
-                    lineno = l[3] + v.count('\n')
-                    pos = len(v) - v.rindex('\n') - 2
-                    pos_stack = pos_stack[:-1] + ((l[0], l[1], l[2], lineno, pos),)
-                return ret
+                # Only note where the token is. pos_stack is worked
+                # out from it if it is needed
+                t.__class__ = _Token
+                lexer = t.lexer
+                if lexer.base:
+                    t.lexpos += lexer.base
+                if lexer.anchored:
+                    t.ctx = lexer.ctx
+                    t.offset = t.lexpos + lexer.delta
+                return f(t)
             new_f.regex = r
             new_f.__doc__ = f.__doc__
             new_f.lineno   = f.__code__.co_firstlineno
@@ -91,69 +211,60 @@ def vLexer():
 
     @TOKEN(r'`(?P<type>[a-z_0-9]+)\((?P<value>[^)]*)\)')
     def t_ANCHOR(t):
-        nonlocal pos_stack, lex_offset
-        type_ = t.lexer.lexmatch.group('type')
-        value = t.lexer.lexmatch.group('value')
-        l = pos_stack[-1]
-        #print("in ANCHOR " + repr(pos_stack), type_,value)
+        lexer = t.lexer
+        type_ = lexer.lexmatch.group('type')
+        value = lexer.lexmatch.group('value')
+        end = t.lexpos + len(t.value)
+        contexts = lexer.sourcemap.contexts
+        #print("in ANCHOR " + repr(lexer.ctx), type_,value)
         if type_ == "pos":
             line, pos = (int(x) for x in value.split(","))
-            t.lexer.lineno = line
-            if line > l[3]:
-                pos_stack = pos_stack[:-1] + ((l[0], l[1], l[2], line, l[4]),)
-            lex_offset = pos - t.lexpos
-        elif type_ == "file":
-            pos_stack += (('file', value, 0, 1, 0),)
-        elif type_ == "endfile":
-            assert l[0] == "file"
-            assert l[1] == value
-            pos_stack = pos_stack[:-1]
-            if pos_stack:
-                assert pos_stack[-1][0] in ("file", "void"), "endfile was %s" % repr(pos_stack[-1]) # Cannot `include with a macro
-                #print("Back to file %s" % pos_stack[-1].value)
-        elif type_ == "macro":
-            pos_stack += (('macro', value, 0, 1, 0),)
-            #print("Entering macro %s" % value)
-        elif type_ == "endmacro":
-            pos_stack = pos_stack[:-1]
-            assert l[0] == "macro"
-            assert l[1] == value
-            #print("Leaving macro %s" % value)
+            lexer.lineno = line
+            lexer.delta = pos - end
+        elif type_ in ("file", "macro"):
+            # Included or expanded where the anchor is
+            lexer.ctx_stack.append((lexer.ctx, lexer.delta))
+            offset = t.lexpos + lexer.delta if lexer.ctx >= 0 else 0
+            lexer.ctx = lexer.sourcemap.context(lexer.ctx, offset, type_, value)
+            lexer.delta = -end
+            #print("Entering %s %s" % (type_, value))
+        elif type_ in ("endfile", "endmacro"):
+            assert contexts[lexer.ctx][2:] == (type_[3:], value)
+            lexer.ctx, lexer.delta = lexer.ctx_stack.pop()
+            if type_ == "endfile" and lexer.ctx >= 0:
+                # Cannot `include with a macro
+                assert contexts[lexer.ctx][2] == "file", "endfile was in %s" % repr(contexts[lexer.ctx])
+            #print("Leaving %s %s" % (type_, value))
         else:
             assert False, "Unknown anchor %s" % type_
-        #assert lex_offset >= 0, "lex_offset=%d, should be >= 0" % lex_offset
-        lex_offset += len(t.value)
-        #print("Return ANCHOR", pos_stack)
         return None
 
-    prev_decl = None
-    block_comment = None
-    prev_id = None
     @TOKEN(r'(\\\S+)|([a-zA-Z_]\w*)')
     def t_ID(t):
-        nonlocal prev_decl, block_comment, prev_id
+        lexer = t.lexer
         t.line_comment = None
         if t.value[0] == '\\':
             t.value = t.value[1:]
         t.type = keyword_map.get(t.value, 'ID')
         if t.type == 'ID':
-            if not prev_decl:
+            if not lexer.prev_decl:
                 # prev_decl is set to None on newline
                 # This allows us to set the comment on the first identifier
                 # on the line
-                prev_decl = t
-            t.block_comment = block_comment
-            block_comment = None
-        prev_id = t
+                lexer.prev_decl = t
+            t.block_comment = lexer.block_comment
+            lexer.block_comment = None
+        lexer.prev_id = t
         return t
 
     @TOKEN(r'\$\w*')
     def t_SYS_ID(t):
+        lexer = t.lexer
         t.line_comment = None
-        t.block_comment = block_comment
+        t.block_comment = lexer.block_comment
         t.type = "SYS_ID"
-        block_comment = None
-        prev_id = t
+        lexer.block_comment = None
+        lexer.prev_id = t
         return t
 
     @TOKEN(r'([0-9]*\.[0-9]+|[0-9]+\.|[0-9]+\.?[0-9]*e[0-9]+)')
@@ -163,9 +274,7 @@ def vLexer():
 
     @TOKEN(r'([0-9]*\'([bB](?P<bin>[01_zxZX?]+)|[hH][0-9a-fA-F_zxZX?]+|[dD][0-9_]+)|[0-9]+)')
     def t_NUMBER(t):
-        nonlocal pos_stack
         t.value = VerilogNumber(t)
-        #t.value.pos_stack = pos_stack[1:]
         return t
 
     @TOKEN(r'"(\\"|[^"])*"')
@@ -174,26 +283,29 @@ def vLexer():
         return t
 
     def annotate_comment(t):
-        nonlocal prev_decl, block_comment
-        if prev_decl != None:
+        lexer = t.lexer
+        if lexer.prev_decl != None:
             #print("*** Annotating comment " + t.value)
-            if prev_decl.lineno == t.lineno:
-                #print("*** Adding a line comment to "+repr(prev_decl))
-                prev_decl.line_comment = t
+            if lexer.prev_decl.lineno == t.lineno:
+                #print("*** Adding a line comment to "+repr(lexer.prev_decl))
+                lexer.prev_decl.line_comment = t
+                # The Id of it may have been made already
+                node = getattr(lexer.prev_decl, 'node', None)
+                if node is not None:
+                    node.line_comment = t.value
             else:
-                block_comment = t
-            prev_decl = None
+                lexer.block_comment = t
+            lexer.prev_decl = None
         else:
-            block_comment = t;
+            lexer.block_comment = t;
 
     @TOKEN(r'//[^\n]*')
     def t_LINE_COMMENT(t):
         #print("Got line comment: "+t.value)
         annotate_comment(t)
 
-    def _get_file():
-        nonlocal pos_stack
-        for p in reversed(pos_stack):
+    def _get_file(t):
+        for p in reversed(t.pos_stack):
             if p[0] == 'file': return p
         assert False
 
@@ -208,7 +320,7 @@ def vLexer():
                 raise Exception("python code with unclean white prefix")
             lines.append(line[len(white_prefix):])
         source = '\n'.join(lines)
-        filepos = _get_file()
+        filepos = _get_file(t)
         filename = filepos[1]
         first_line = filepos[3]
         t.value = (source, filename, first_line)
@@ -233,10 +345,9 @@ def vLexer():
     #t_ignore = ''
     @TOKEN(r'\n+')
     def t_newline(t):
-        nonlocal prev_decl
         n = len(t.value)
         t.lexer.lineno += n
-        prev_decl = None
+        t.lexer.prev_decl = None
         
     @TOKEN(r'[ \t\r]+')
     def t_white(t):
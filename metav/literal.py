@@ -14,7 +14,7 @@
 # along with metav.  If not, see <http://www.gnu.org/licenses/>.
 
 import re
-from .vast import Expression, _get_end
+from .vast import Expression, _start, _stop
 
 UNSIZED = re.compile(r'^[0-9]+$')
 BIN     = re.compile(r'^(?P<size>[0-9]*)\'[bB](?P<bin>[01_zxZX?]+)$')
@@ -22,11 +22,12 @@ DEC     = re.compile(r'^(?P<size>[0-9]*)\'[dD](?P<dec>[0-9_]+)$')
 HEX     = re.compile(r'^(?P<size>[0-9]*)\'[hH](?P<hex>[0-9a-fA-FzxZX?_]+)$')
 
 class VerilogNumber(Expression):
+    __slots__ = ('orig', 'value', 'size', 'xmask', 'zmask')
     def __init__(self, string):
         if type(string) == str:
             self.pos = ((),())
         else:
-            self.pos = (string.pos_stack, _get_end(string))
+            self._set_pos(_start(string), _stop(string))
             string = string.value
         self.orig = string
         unz = UNSIZED.match(string)
@@ -109,8 +110,9 @@ class VerilogNumber(Expression):
         return self.size
 
 class String(VerilogNumber):
+    __slots__ = ()
     def __init__(self, string):
-        self.pos = (string.pos_stack, _get_end(string))
+        self._set_pos(_start(string), _stop(string))
         string = string.value
         self.value = 0 # TODO
         self.xmask = 0
@@ -119,5 +121,6 @@ class String(VerilogNumber):
         self.orig = string
 
 class VerilogReal(Expression):
+    __slots__ = ('string',)
     def __init__(self, string):
         self.string = string
@@ -0,0 +1,129 @@
+# This file is part of metav.
+
+# metav is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# metav is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with metav.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Record of what the output of each top was made from, to skip the
+tops that are up to date"""
+
+import os
+import json
+import hashlib
+
+def _stamp(path):
+    "Return [mtime, size, content hash] of path"
+    st = os.stat(path)
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    return [st.st_mtime_ns, st.st_size, digest]
+
+def stamps(paths):
+    "Return the stamps of paths, to give Manifest.record"
+    return dict((p, _stamp(p)) for p in paths)
+
+class Manifest(object):
+    """What the output of each top was made from, kept in the JSON file
+    path
+
+    For each top it has the module and include paths it was processed
+    with, the content hashes of the files it was preprocessed from and
+    of the files written from its edit plan, and the signatures of the
+    ports of the modules it instantiates, as their metav code left them.
+    The metav code is in the files, so changes to it show in their
+    hashes.
+
+    Files are only read again to hash them when their size or
+    modification time changed."""
+    # Change when what is stored changes
+    version = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.tops = {}
+        self.skipped = 0
+        self.dirty = False
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('version') == self.version:
+                self.tops = data['tops']
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            print("Ignoring unreadable manifest %s: %r" % (path, e))
+
+    def _same(self, stamps):
+        "Return True if the files in stamps are as they were"
+        for path, (mtime, size, digest) in stamps.items():
+            try:
+                st = os.stat(path)
+            except OSError:
+                return False
+            if st.st_mtime_ns == mtime and st.st_size == size:
+                continue
+            new = _stamp(path)
+            if new[2] != digest:
+                return False
+            # Touched, but the same
+            stamps[path] = new
+            self.dirty = True
+        return True
+
+    def up_to_date(self, top, interface, settings):
+        """Return True if nothing the output of top was made from has
+        changed
+
+        settings is what record was given. interface(name) returns
+        (stamps, signature) of the module name, and is only called for
+        modules whose files changed."""
+        entry = self.tops.get(top)
+        if entry is None or entry['settings'] != settings:
+            return False
+        if not self._same(entry['files']) or not self._same(entry['outputs']):
+            return False
+        for name, (files, signature) in entry['ports'].items():
+            if self._same(files):
+                continue
+            try:
+                files, new = interface(name)
+            except Exception:
+                return False
+            if new != signature:
+                return False
+            entry['ports'][name] = [files, signature]
+            self.dirty = True
+        self.skipped += 1
+        return True
+
+    def record(self, top, files, outputs, ports, settings):
+        """Record that the output of top is made from files, to
+        outputs, with ports mapping the names of the modules it
+        instantiates to (stamps, signature). files and outputs are
+        stamps as from metav.manifest.stamps, and settings a dict of
+        lists and strings of what else it depends on"""
+        self.tops[top] = {'settings': settings,
+                          'files': files, 'outputs': outputs,
+                          'ports': dict((name, list(p))
+                                        for name, p in ports.items())}
+        self.dirty = True
+
+    def save(self):
+        "Write the manifest, if it changed"
+        if not self.dirty:
+            return
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'version': self.version, 'tops': self.tops}, f,
+                      indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+        self.dirty = False
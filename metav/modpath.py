@@ -0,0 +1,122 @@
+# This file is part of metav.
+
+# metav is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# metav is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with metav.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Lookup of module files in the module path"""
+
+import os
+import threading
+
+class ModPath(object):
+    """Index of the files in the directories of modpath, read with one
+    os.scandir each
+
+    A module is found in the first directory that has it, as when
+    trying each in turn. Names that are paths, not file names, are
+    looked up by trying each directory, and those not found are
+    remembered until the next refresh.
+
+    generation counts the refreshes that found a directory changed."""
+    def __init__(self, modpath=('.',)):
+        self.modpath = tuple(modpath)
+        self.generation = 0
+        self._dirs = []
+        self._files = {}
+        self._paths = {}
+        for p in self.modpath:
+            self._dirs.append(self._scan(p))
+        self._merge()
+
+    def _scan(self, directory):
+        "Return (directory, its mtime, {file name: path})"
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+            with os.scandir(directory) as it:
+                names = dict((e.name, os.path.join(directory, e.name))
+                             for e in it if e.is_file())
+        except (FileNotFoundError, NotADirectoryError):
+            return directory, None, {}
+        return directory, mtime, names
+
+    def _merge(self):
+        self._files = {}
+        for directory, mtime, names in reversed(self._dirs):
+            self._files.update(names)
+        self._paths = {}
+
+    def refresh(self):
+        """Read the directories that changed since they were read again.
+        Returns True if any did"""
+        # Files under a subdirectory do not change its parent's mtime
+        self._paths = {}
+        changed = False
+        for i, (directory, mtime, names) in enumerate(self._dirs):
+            try:
+                now = os.stat(directory).st_mtime_ns
+            except OSError:
+                now = None
+            if now != mtime:
+                self._dirs[i] = self._scan(directory)
+                changed = True
+        if changed:
+            self._merge()
+            self.generation += 1
+        return changed
+
+    def find(self, modulename):
+        "Return the file of module modulename, or raise IOError"
+        if "." not in modulename:
+            modulename += ".v"
+        if os.sep in modulename or (os.altsep and os.altsep in modulename):
+            filename = self._paths.get(modulename, False)
+            if filename is False:
+                filename = self._paths[modulename] = self._try(modulename)
+        else:
+            filename = self._files.get(modulename)
+        if filename is None:
+            raise IOError("Could not find " + modulename + " in " +
+                          ', '.join(self.modpath))
+        return filename
+
+    def _try(self, modulename):
+        for p in self.modpath:
+            filename = os.path.join(p, modulename)
+            if os.path.isfile(filename):
+                return filename
+        return None
+
+# The indexes handed out by index, one per module path
+_indexes = {}
+_lock = threading.Lock()
+
+def index(modpath=('.',)):
+    "Return the ModPath of modpath, shared by every caller in the process"
+    key = tuple(modpath)
+    with _lock:
+        ret = _indexes.get(key)
+        if ret is None:
+            ret = _indexes[key] = ModPath(key)
+    return ret
+
+def refresh():
+    """Refresh every index handed out by index, as a process that stays
+    up has to before it looks for modules again. Returns True if any
+    directory changed"""
+    with _lock:
+        indexes = list(_indexes.values())
+    changed = False
+    for i in indexes:
+        if i.refresh():
+            changed = True
+    return changed
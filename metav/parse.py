@@ -1,13 +1,20 @@
+import os
+import sys
+import copy
+import hashlib
+import threading
 import ply.yacc
 from ply.yacc import GRAMMAR as G
-from .lex import tokens
+from .lex import tokens, vLexer, feed
+from . import stats
 import metav.vast as ast
 
 @G('''source : empty
-             | module source''')
+             | source module''')
 def p_source(p):
-    if p[1]:
-        p[0] = [p[1]] + p[2]
+    if len(p) > 2:
+        p[1].append(p[2])
+        p[0] = p[1]
     else:
         p[0] = []
 @G('empty :')
@@ -114,10 +121,11 @@ def p_range(p):
     p[0].parse_info(p.slice[1], p.slice[5])
 
 @G("""list_of_ids : id
-                  | id ',' list_of_ids""")
+                  | list_of_ids ',' id""")
 def p_list_of_ids(p):
     if len(p) > 2:
-        p[0] = [p[1]] + p[3]
+        p[1].append(p[3])
+        p[0] = p[1]
     else:
         p[0] = [p[1]]
 
@@ -131,11 +139,12 @@ def p_inout_decl(p):
     p[0] = ast.Inout(p[3], range=p[2])
     p[0].parse_info(p.slice[1])
 
-@G("""module_items : module_item module_items
+@G("""module_items : module_items module_item
                    | empty""")
 def p_module_items(p):
     if len(p) > 2:
-        p[0] = [p[1]] + p[2]
+        p[1].append(p[2])
+        p[0] = p[1]
     else:
         p[0] = []
 
@@ -195,10 +204,11 @@ def p_generate_case(p):
     p[0].parse_info(p.slice[1], p.slice[6])
 
 @G("""generate_case_items : empty
-                          | generate_case_item generate_case_items""")
+                          | generate_case_items generate_case_item""")
 def p_generate_case_items(p):
-    if p[1]:
-        p[0] = [p[1]] + p[2]
+    if len(p) > 2:
+        p[1].append(p[2])
+        p[0] = p[1]
     else:
         p[0] = []
 
@@ -218,10 +228,11 @@ def p_generate_block(p):
     p[0].parse_info(p.slice[1], p.slice[5])
 
 @G("""generate_items : empty
-                     | generate_item generate_items""")
+                     | generate_items generate_item""")
 def p_generate_items(p):
-    if p[1]:
-        p[0] = [p[1]] + p[2]
+    if len(p) > 2:
+        p[1].append(p[2])
+        p[0] = p[1]
     else:
         p[0] = []
 
@@ -242,10 +253,11 @@ def p_automatic_yes(p):
     p[0] = True
 
 @G("""function_item_declarations : function_item_declaration
-                                 | function_item_declaration function_item_declarations""")
+                                 | function_item_declarations function_item_declaration""")
 def p_function_item_declarations(p):
     if len(p) > 2:
-        p[0] = [p[1]] + p[2]
+        p[1].append(p[2])
+        p[0] = p[1]
     else:
         p[0] = [p[1]]
 
@@ -263,10 +275,11 @@ def p_parameter_decl(p):
     p[0].parse_info(p.slice[1])
 
 @G("""id_assigns : id_assign
-                 | id_assign ',' id_assigns""")
+                 | id_assigns ',' id_assign""")
 def p_id_assigns(p):
     if len(p) > 2:
-        p[0] = [p[1]] + p[3]
+        p[1].append(p[3])
+        p[0] = p[1]
     else:
         p[0] = [p[1]]
 
@@ -285,11 +298,12 @@ def p_reg_decl(p):
     p[0] = ast.Reg(p[3], range=p[2])
     p[0].parse_info(p.slice[1])
 
-@G("""reg_ids : reg_id ',' reg_ids
+@G("""reg_ids : reg_ids ',' reg_id
               | reg_id""")
 def p_reg_ids(p):
     if len(p) > 2:
-        p[0] = [p[1]] + p[3]
+        p[1].append(p[3])
+        p[0] = p[1]
     else:
         p[0] = [p[1]];
 
@@ -305,11 +319,12 @@ def p_continous_assign(p):
     p[0] = ast.ContAssigns(p[2])
     p[0].parse_info(p.slice[1])
 
-@G("""assigns : assign ',' assigns
+@G("""assigns : assigns ',' assign
               | assign""")
 def p_assigns(p):
     if len(p) > 2:
-        p[0] = [p[1]] + p[3]
+        p[1].append(p[3])
+        p[0] = p[1]
     else:
         p[0] = [p[1]]
 
@@ -435,11 +450,12 @@ def p_arglist_opt(p):
     else:
         p[0] = []
 
-@G("""statements : statement statements
+@G("""statements : statements statement
                  | empty""")
 def p_statements(p):
     if len(p) > 2:
-        p[0] = [p[1]] + p[2]
+        p[1].append(p[2])
+        p[0] = p[1]
     else:
         p[0] = []
 
@@ -529,11 +545,12 @@ def p_repetition(p):
     p[0] = ast.Repetition(p[2], p[3])
     p[0].parse_info(p.slice[1], p.slice[4])
 
-@G("""expressions : expression ',' expressions
+@G("""expressions : expressions ',' expression
                   | expression""")
 def p_expressions(p):
     if len(p) > 2:
-        p[0] = [p[1]] + p[3]
+        p[1].append(p[3])
+        p[0] = p[1]
     else:
         p[0] = [p[1]]
 
@@ -606,8 +623,166 @@ def p_error(p):
     print("Syntax error in input!")
     print(p)
 
-def vParser():
-    return ply.yacc.yacc()
+# Parsers by the cache_dir given to vParser
+_parsers = {}
+_parser_lock = threading.Lock()
+
+def vParser(cache_dir=None):
+    """Return a parser for the tokens of metav.lex.vLexer
+
+    The LALR tables are generated once, into a file in cache_dir named
+    after a hash of the grammar, and loaded from there after that. By
+    default cache_dir is the __pycache__ of this package, or metav in
+    the user's cache directory if that can not be written to. If
+    neither can, the tables are generated in memory. All parsers from
+    the same cache_dir share the same tables, which are never changed,
+    and keep the rest of their state to themselves. Together with a
+    lexer of its own, each can parse in a thread of its own."""
+    if cache_dir is not None:
+        cache_dir = os.path.abspath(cache_dir)
+    with _parser_lock:
+        parser = _parsers.get(cache_dir)
+        if parser is None:
+            directory = cache_dir
+            if directory is None:
+                directory = _default_cache_dir()
+            parser = _parsers[cache_dir] = _load_parser(directory)
+    return copy.copy(parser)
+
+def _writable(directory):
+    "Create directory if need be, and return whether it can be written to"
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError:
+        return False
+    return os.access(directory, os.W_OK)
+
+def _default_cache_dir():
+    """Return the directory to keep parse tables in by default, or None
+    if there is none that can be written to"""
+    package = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           '__pycache__')
+    user = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                        os.path.join(os.path.expanduser('~'), '.cache'),
+                        'metav')
+    for directory in (package, user):
+        if _writable(directory):
+            return directory
+    return None
+
+# Module items kept by parse_header, and the items it skips the
+# insides of
+_header_items = {'INPUT', 'OUTPUT', 'INOUT', 'PARAMETER', 'LOCALPARAM'}
+_skipped_items = {'FUNCTION': 'ENDFUNCTION', 'GENERATE': 'ENDGENERATE'}
+
+def _header_tokens(lexer):
+    """Yield the tokens of module headers and endmodule, and of the port
+    and parameter declarations in the module bodies"""
+    in_body = False
+    in_decl = False
+    end = None
+    for t in iter(lexer.token, None):
+        if not in_body:
+            yield t
+            in_body = t.type == "';'"
+        elif end:
+            if t.type == end:
+                end = None
+        elif in_decl:
+            yield t
+            in_decl = t.type != "';'"
+        elif t.type in _header_items:
+            yield t
+            in_decl = True
+        elif t.type in _skipped_items:
+            end = _skipped_items[t.type]
+        elif t.type == 'ENDMODULE':
+            yield t
+            in_body = False
+
+def parse_header(text, sourcemap=None):
+    """Parse only the headers of the modules in text, and the port and
+    parameter declarations in their bodies
+
+    Returns the modules like vParser().parse, but with only these
+    declarations in items."""
+    with stats.phase('parse_header'):
+        lexer = vLexer(sourcemap)
+        lexer.input(text)
+        header = _header_tokens(lexer)
+        return vParser().parse(lexer=lexer,
+                               tokenfunc=lambda: next(header, None))
+
+def parse(text, sourcemap=None, debug=False):
+    """Parse text from metav.preproc.preproc, and return the modules
+
+    text can also be an iterator over pieces of it, as from
+    metav.preproc.preproc_iter with a source map. It is then lexed a
+    window at a time, as it comes, without the whole text being put
+    together.
+
+    A lexer and parser is made for the call, so it can be made from
+    several threads at once.
+
+    Lexing, and preprocessing when text is an iterator, is done as the
+    parser asks for tokens, so its time is in that of the parse phase."""
+    lexer = vLexer(sourcemap)
+    if isinstance(text, str):
+        lexer.input(text)
+        get_token = lexer.token
+    else:
+        get_token = feed(lexer, text)
+    if not stats.enabled:
+        return vParser().parse(lexer=lexer, debug=debug, tokenfunc=get_token)
+    with stats.phase('parse'):
+        n = 0
+        def token():
+            nonlocal n
+            n += 1
+            return get_token()
+        try:
+            return vParser().parse(lexer=lexer, debug=debug, tokenfunc=token)
+        finally:
+            stats.count('tokens', n)
+
+def _grammar_hash():
+    "Hash of everything the parse tables are generated from"
+    module = sys.modules[__name__]
+    h = hashlib.sha1()
+    h.update(repr((ply.yacc.__tabversion__, sorted(tokens), precedence)).encode())
+    for name in sorted(dir(module)):
+        if name.startswith('p_') and name != 'p_error':
+            h.update(repr((name, getattr(module, name).__doc__)).encode())
+    return h.hexdigest()[:16]
+
+def _load_parser(cache_dir):
+    """Return a parser with the tables in cache_dir, which are generated
+    there if they are not. If cache_dir is None, or can not be written
+    to, they are generated in memory only"""
+    module = sys.modules[__name__]
+    if cache_dir is None:
+        return ply.yacc.yacc(module=module, debug=False, write_tables=False)
+    filename = os.path.join(cache_dir, 'parsetab-%s.pickle' % _grammar_hash())
+    if os.path.exists(filename):
+        try:
+            # The hash is checked, so skip what yacc() would check again
+            tables = ply.yacc.LRTable()
+            tables.read_pickle(filename)
+            tables.bind_callables(vars(module))
+            return ply.yacc.LRParser(tables, p_error)
+        except Exception as e:
+            print("Could not load parse tables %s: %r" % (filename, e))
+    # Write to a temporary file first, so that other processes never
+    # see half a table
+    tmp = "%s.%d.tmp" % (filename, os.getpid())
+    if not _writable(cache_dir):
+        return ply.yacc.yacc(module=module, debug=False, write_tables=False)
+    parser = ply.yacc.yacc(module=module, debug=False, picklefile=tmp)
+    try:
+        os.replace(tmp, filename)
+    except OSError:
+        pass
+    return parser
 
 if __name__ == "__main__":
     from preproc import preproc
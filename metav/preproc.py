@@ -13,43 +13,246 @@
 # You should have received a copy of the GNU General Public License
 # along with metav.  If not, see <http://www.gnu.org/licenses/>.
 
-import re,os.path
+import re,os.path,collections,threading
+from . import stats
+
+class IncludeCache(object):
+    """A bounded LRU cache of preprocessed include files
+
+    An entry holds the text, edit plan and defines that came out of
+    preprocessing a file. It is reused as long as none of the files
+    it was made from have changed size or mtime, and all the defines
+    it looked at still have the same values. hits and misses count
+    the lookups.
+
+    It can be shared by threads preprocessing at the same time."""
+    def __init__(self, maxsize=256, variants=4):
+        self.maxsize = maxsize
+        self.variants = variants
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def key(self, p, state):
+        return (os.path.abspath(p), p, tuple(state['incpath']),
+                state['in_ifdef'], state['sourcemap'] is not None)
+
+    def lookup(self, key, state):
+        with self._lock:
+            variants = list(self.entries.get(key, ()))
+        # Entries are never changed once stored, so they can be
+        # checked without holding the lock
+        for entry in variants:
+            if self._fresh(entry, state['defines']):
+                with self._lock:
+                    if key in self.entries:
+                        self.entries.move_to_end(key)
+                    self.hits += 1
+                stats.count('include_cache_hits')
+                return entry
+        with self._lock:
+            self.misses += 1
+        stats.count('include_cache_misses')
+        return None
+
+    def store(self, key, entry):
+        with self._lock:
+            # Keep a few entries per file, for different sets of defines
+            variants = self.entries.setdefault(key, [])
+            variants.insert(0, entry)
+            del variants[self.variants:]
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def _fresh(self, entry, defines):
+        for name, value in entry['uses'].items():
+            if defines.get(name) != value:
+                return False
+        for (p, mtime, size) in entry['stamps']:
+            try:
+                st = os.stat(p)
+            except OSError:
+                return False
+            if st.st_mtime_ns != mtime or st.st_size != size:
+                return False
+        return True
+
+include_cache = IncludeCache()
+
+def _use(state, name):
+    "Look up a define, noting it as an input to the includes being cached"
+    value = state['defines'].get(name)
+    for scope in state['include_scopes']:
+        if name not in scope['defines']:
+            scope['uses'].setdefault(name, value)
+    return value
+
+def _set_define(state, name, value):
+    state['defines'][name] = value
+    for scope in state['include_scopes']:
+        scope['defines'][name] = value
+
+def _set_guard(state, p, name):
+    state['guards'][p] = name
+    for scope in state['include_scopes']:
+        scope['guards'][p] = name
 
 def _include(m, state, filestate):
     if not state['ifdef']: return ""
     filename = m.group(1)
     for p in state['incpath']:
         p = os.path.join(p, filename)
-        if os.path.isfile(p):
-            ret, edit_plan = preproc(p, state)
-            filestate['edit_plan'] += edit_plan
-            filestate['includes'] += filename
-            return ret
+        guard = state['guards'].get(p)
+        if guard is not None and _use(state, guard) is not None:
+            # Already included, and everything in it is disabled now
+            stats.count('guarded_includes')
+            filestate['includes'].append(filename)
+            return ""
+        if guard is not None or os.path.isfile(p):
+            cache = state['include_cache']
+            if cache is None:
+                return _include_file(p, filename, state, filestate, None)
+            key = cache.key(p, state)
+            entry = cache.lookup(key, state)
+            if entry is None:
+                return _include_file(p, filename, state, filestate, key)
+            _reuse(entry, filename, state, filestate)
+            return _cached(entry, state, filestate)
     raise IOError("Could not find %s in include path" % (filename, ))
 
+def _include_file(p, filename, state, filestate, key):
+    "Yield the preprocessed text of an included file, piece by piece"
+    st = os.stat(p)
+    scope = {'uses': {}, 'defines': {}, 'guards': {}, 'stamps': []}
+    scopes = state['include_scopes']
+    if key is not None:
+        scopes.append(scope)
+    for s in scopes:
+        s['stamps'].append((p, st.st_mtime_ns, st.st_size))
+    in_ifdef = state['in_ifdef']
+    sourcemap = state['sourcemap']
+    if sourcemap is not None:
+        first_ctx = len(sourcemap.contexts)
+        base = sourcemap.size
+    chunks, childstate = _open(p, state, filestate)
+    edit_plan = childstate['edit_plan']
+    text = ''
+    for chunk in chunks:
+        yield chunk
+        if key is not None:
+            # Grown in place, as for preproc
+            text += chunk
+    filestate['edit_plan'] += edit_plan
+    filestate['includes'].append(filename)
+    if key is None:
+        return
+    scopes.pop()
+    if state['in_ifdef'] == in_ifdef and state['ifdef']:
+        state['include_cache'].store(key, {
+                'text': text,
+                'map': sourcemap and _map_fragment(sourcemap, base, first_ctx),
+                'edit_plan': edit_plan,
+                'uses': scope['uses'],
+                'defines': scope['defines'],
+                'guards': scope['guards'],
+                'stamps': scope['stamps'],
+                })
+
+def _map_fragment(sourcemap, base, first_ctx):
+    "Cut out the contexts and segments of an include, relative to it"
+    contexts = []
+    for (parent, offset, type_, name) in sourcemap.contexts[first_ctx:]:
+        if parent < first_ctx:
+            # The file including it, at the `include
+            parent, offset = -1, 0
+        else:
+            parent -= first_ctx
+        contexts.append((parent, offset, type_, name))
+    segments = []
+    i = len(sourcemap.starts) - 1
+    while i >= 0 and sourcemap.ctxs[i] >= first_ctx:
+        segments.append((sourcemap.starts[i] - base, sourcemap.offsets[i],
+                         sourcemap.ctxs[i] - first_ctx))
+        i -= 1
+    segments.reverse()
+    return contexts, segments
+
+def _cached(entry, state, filestate):
+    "Yield the text of a cached include"
+    sourcemap = state['sourcemap']
+    if sourcemap is not None:
+        contexts, segments = entry['map']
+        first_ctx = len(sourcemap.contexts)
+        for (parent, offset, type_, name) in contexts:
+            if parent < 0:
+                parent, offset = filestate['ctx'], filestate['char']
+            else:
+                parent += first_ctx
+            sourcemap.context(parent, offset, type_, name)
+        for (start, offset, ctx) in segments:
+            sourcemap.segment(ctx + first_ctx, offset,
+                              start + sourcemap.size)
+    yield entry['text']
+
+def _reuse(entry, filename, state, filestate):
+    "Have the same side effects as preprocessing a cached include again"
+    for name in entry['uses']:
+        _use(state, name)
+    for name, value in entry['defines'].items():
+        _set_define(state, name, value)
+    for p, name in entry['guards'].items():
+        _set_guard(state, p, name)
+    for s in state['include_scopes']:
+        s['stamps'] += entry['stamps']
+    filestate['edit_plan'] += entry['edit_plan']
+    filestate['includes'].append(filename)
+
 def _macro(m, state, filestate):
     if not state['ifdef']: return ""
     macro = m.group(1)
     #print("macro: "+macro)
-    if macro in state['defines']:
-        macrostate = {
-            'filename': filestate['filename']+'%'+macro,
-            'char': 0,
-            'lineno': 1,
-            }
-        ret = _process(state['defines'][macro], state, macrostate)
-        return "`macro(%s)%s`endmacro(%s)" % \
-            (macro, ret, macro)
+    value = _use(state, macro)
+    if value is not None:
+        return _expand(macro, value, state, filestate)
     else:
         return ""
 
+def _expand(macro, value, state, filestate):
+    "Yield the expansion of a macro, piece by piece"
+    macrostate = {
+        'filename': filestate['filename']+'%'+macro,
+        'char': 0,
+        'lineno': 1,
+        }
+    sourcemap = state['sourcemap']
+    if sourcemap is None:
+        yield "`macro(%s)" % macro
+    else:
+        sourcemap.source('macro', macro, value)
+        macrostate['ctx'] = sourcemap.context(filestate['ctx'],
+                                              filestate['char'],
+                                              'macro', macro)
+        sourcemap.segment(macrostate['ctx'], 0)
+    yield from _iter_process(value, state, macrostate)
+    if sourcemap is None:
+        yield "`endmacro(%s)" % macro
+
 def _define(m, state, filestate):
     if not state['ifdef']: return ""
     macro = m.group(1)
     value = m.group(2)
     #print("define "+macro+"="+value)
-    assert macro not in state['defines']
-    state['defines'][macro] = value
+    defined = _use(state, macro)
+    assert defined is None
+    _set_define(state, macro, value)
     return ""
 
 def _drop(m, state, filestate):
@@ -61,52 +264,145 @@ def _drop(m, state, filestate):
 
 def _ifdef(m, state, filestate):
     var = m.group(1)
-    if var not in state['defines']:
+    state['ifdef_stack'].append(state['ifdef'])
+    if state['ifdef'] and _use(state, var) is None:
         state['ifdef'] = False
     state['in_ifdef'] += 1
     return ""
 def _ifndef(m, state, filestate):
     var = m.group(1)
-    if var in state['defines']:
+    state['ifdef_stack'].append(state['ifdef'])
+    if state['ifdef'] and _use(state, var) is not None:
         state['ifdef'] = False
     state['in_ifdef'] += 1
     return ""
 def _else(m, state, filestate):
-    state['ifdef'] = not state['ifdef']
     if state['in_ifdef'] <= 0:
         raise Exception("Spurious `else")
+    # Only the innermost `ifdef is flipped. Nested in a disabled
+    # region, both branches stay disabled
+    state['ifdef'] = state['ifdef_stack'][-1] and not state['ifdef']
     return ""
 def _endif(m, state, filestate):
-    state['ifdef'] = True
-    state['in_ifdef'] -= 1
-    if state['in_ifdef'] < 0:
+    if state['in_ifdef'] <= 0:
         raise Exception("Spurious `endif")
+    state['ifdef'] = state['ifdef_stack'].pop()
+    state['in_ifdef'] -= 1
     return ""
 
 regexs = (
     (r'//[^\n]*',       None),    # Line comments
     (r'/\*metav_delete:', _drop),
     (r':metav_delete\*/', _drop),
-    (r'/\*metav_generated:\*/(.|\n)*?/\*:metav_generated\*/', _drop),
-    (r'/\*(.|\n)*?\*/', None),    # Block comments
-    (r'"(\\"|[^"])*"', None),     # Strings
+    (r'/\*metav_generated:\*/[\s\S]*?/\*:metav_generated\*/', _drop),
+    (r'/\*[\s\S]*?\*/', None),    # Block comments
+    (r'"(?:\\"|[^"])*"', None),   # Strings
     (r'`include\s+"([^"]+)"', _include),
     (r'`ifdef\s+(\S+)', _ifdef),
     (r'`ifndef\s+(\S+)', _ifndef),
     (r'`else', _else),
     (r'`endif', _endif),
-    (r'`define\s+([A-Za-z0-9_]+)\s+(.*?)(?=\n|//|/\*)', _define),
+    (r'`define\s+([A-Za-z0-9_]+)[ \t]*(.*?)(?=\n|//|/\*|$)', _define),
     (r'`([A-Za-z_0-9]+)', _macro),
-    (r'(.|\n)([^/`":]|\n)*', None), # Match the rest, as greedy as possible
+    (r'[\s\S][^/`":]*', None), # Match the rest, as greedy as possible
     )
 
-regexs = [(re.compile('^'+r), a) for (r, a) in regexs]
+# All the regexs are tried at once, in order, as alternatives of one
+# combined pattern. lastindex then identifies the alternative that
+# matched, as its enclosing group is the last one to close.
+_scanner = re.compile('|'.join('(%s)' % r for (r, a) in regexs))
+regexs = [(re.compile(r), a) for (r, a) in regexs]
+
+def _number_rules(regexs):
+    "Return the rules by the number of the group enclosing each"
+    rules = {}
+    index = 1
+    for (regex, action) in regexs:
+        rules[index] = (regex, action)
+        index += 1 + regex.groups
+    return rules
+
+_rules = _number_rules(regexs)
+
+# Where to stop when skipping a disabled `ifdef region: anything that
+# could hide, or be, an `ifdef/`else/`endif, and the metav markers
+# that must be dropped wherever they are
+_skip = re.compile(r'//|/\*|"|:metav_delete\*/|'
+                   r'`(?:ifdef|ifndef|else|endif|define|include)')
+
+# An include guard: `ifndef X `define X ... `endif around everything but
+# comments and whitespace
+_guard_start = re.compile(r'(?:\s|//[^\n]*|/\*(?!metav)[\s\S]*?\*/)*'
+                          r'`ifndef\s+(\S+)\s+`define\s+([A-Za-z0-9_]+)')
+_guard_scan = re.compile(r'//[^\n]*|/\*[\s\S]*?\*/|"(?:\\"|[^"])*"|'
+                         r'`(?:(ifn?def)\s|(else)|(endif))')
+_guard_end = re.compile(r'(?:\s|//[^\n]*|/\*(?!metav)[\s\S]*?\*/)*')
+
+def _find_guard(cont):
+    "Return the macro of an include guard around all of cont, or None"
+    m = _guard_start.match(cont)
+    if not m or m.group(1) != m.group(2):
+        return None
+    depth = 1
+    for d in _guard_scan.finditer(cont, m.end()):
+        if d.group(1):
+            depth += 1
+        elif d.group(2):
+            if depth == 1:
+                return None
+        elif d.group(3):
+            depth -= 1
+            if depth == 0:
+                if _guard_end.fullmatch(cont, d.end()):
+                    return m.group(1)
+                return None
+    return None
+
+def preproc(filename, state = None, out = None):
+    """Preprocess filename, and return (text, edit_plan, includes)
+
+    If out is given, the text is written to it piece by piece with
+    out.write() instead of being collected in memory, and out is
+    returned in its place.
 
-def preproc(filename, state = {}):
+    If state['sourcemap'] is a metav.sourcemap.SourceMap, the text
+    gets no `file, `pos or `macro anchors. Where each part of it came
+    from is recorded in the source map instead."""
+    if state is None: state = {}
+    with stats.phase('preproc'):
+        chunks, edit_plan, includes = preproc_iter(filename, state)
+        if out is None:
+            # The only reference to text is this one, so += grows it in
+            # place instead of copying it, and the text is kept once
+            text = ''
+            for chunk in chunks:
+                text += chunk
+            return text, edit_plan, includes
+        for chunk in chunks:
+            out.write(chunk)
+        return out, edit_plan, includes
+
+def preproc_iter(filename, state = None):
+    """Like preproc, but return the text as an iterator over pieces of it
+
+    edit_plan and includes are filled in as the iterator is consumed"""
+    if state is None: state = {}
     if 'in_ifdef' not in state: state['in_ifdef'] = 0
     if 'ifdef' not in state: state['ifdef'] = True
+    if 'ifdef_stack' not in state: state['ifdef_stack'] = []
     if 'defines' not in state: state['defines'] = {}
     if 'incpath' not in state: state['incpath'] = ('.',)
+    if 'include_cache' not in state: state['include_cache'] = include_cache
+    if 'include_scopes' not in state: state['include_scopes'] = []
+    if 'guards' not in state: state['guards'] = {}
+    if 'sourcemap' not in state: state['sourcemap'] = None
+    chunks, filestate = _open(filename, state, None)
+    if state['sourcemap'] is not None:
+        chunks = _counted(chunks, state['sourcemap'])
+    return chunks, filestate['edit_plan'], filestate['includes']
+
+def _open(filename, state, parent):
+    "Return the text of filename as an iterator, and its filestate"
     filestate = {
         'filename': filename,
         'lineno': 1,
@@ -115,46 +411,96 @@ def preproc(filename, state = {}):
         'includes': [],
         }
     cont = open(filename).read()
-    return ("`file(%s)" % filename +
-            _process(cont, state, filestate) +
-            "`endfile(%s)" % filename,
-            filestate['edit_plan'],
-            filestate['includes'])
-    
-def _process(cont, state, filestate):
-    ret = ""
-    skipped = 0
-    while cont:
-        got_match = False
-        for (regex, action) in regexs:
-            m = regex.match(cont)
-            if not m: continue
-            matched = m.group(0)
-            #print("%s matched %s" % (regex.pattern, repr(matched)))
-            got_match = True
-            end = m.end()
-            assert end > 0
-            if action:
-                gen = action(m, state, filestate)
-            else:
-                if state['ifdef']: gen = matched
-                else:              gen = ""
-            if skipped != 0 and len(gen) > 0:
-                # We continue to emit text after having skipped a section
-                # emit a `pos to tell lexer how much we have skipped
-                ret += "`pos(%d,%d)" % (filestate['lineno'], filestate['char'])
-                skipped = 0;
-            ret += gen
-            if len(gen) != end:
-                # We have removed or added text
-                skipped += end - len(gen)
-            filestate['char']   += end
-            filestate['lineno'] += matched.count('\n')
-            cont = cont[end:]
-            break
-        assert got_match, "One regex must match. %s... unmatched" % (repr(cont[:20]),)
-
-    return ret
+    if stats.enabled:
+        stats.count('files')
+        stats.count('lines', cont.count('\n'))
+    guard = _find_guard(cont)
+    if guard is not None:
+        _set_guard(state, filename, guard)
+    return _iter_file(cont, state, filestate, parent), filestate
+
+def _counted(chunks, sourcemap):
+    "Keep track of the size of the text the source map is for"
+    for chunk in chunks:
+        yield chunk
+        sourcemap.size += len(chunk)
+
+def _iter_file(cont, state, filestate, parent):
+    sourcemap = state['sourcemap']
+    if sourcemap is None:
+        yield "`file(%s)" % filestate['filename']
+    else:
+        if parent is None:
+            filestate['ctx'] = sourcemap.context(-1, 0, 'file',
+                                                 filestate['filename'])
+        else:
+            filestate['ctx'] = sourcemap.context(parent['ctx'],
+                                                 parent['char'], 'file',
+                                                 filestate['filename'])
+        sourcemap.segment(filestate['ctx'], 0)
+    yield from _iter_process(cont, state, filestate)
+    if sourcemap is None:
+        yield "`endfile(%s)" % filestate['filename']
+
+def _resume(state, filestate):
+    """Text is emitted again after some was skipped or added. Return a
+    `pos anchor telling the lexer where in the file we are, or record
+    it in the source map"""
+    sourcemap = state['sourcemap']
+    if sourcemap is None:
+        return "`pos(%d,%d)" % (filestate['lineno'], filestate['char'])
+    sourcemap.segment(filestate['ctx'], filestate['char'])
+    return ""
+
+def _iter_process(cont, state, filestate):
+    resync = False
+    pos = 0
+    size = len(cont)
+    while pos < size:
+        if not state['ifdef']:
+            m = _skip.search(cont, pos)
+            end = m.start() if m else size
+            if end > pos:
+                # Jump over the disabled text in one go
+                resync = True
+                filestate['char']   += end - pos
+                filestate['lineno'] += cont.count('\n', pos, end)
+                pos = end
+                continue
+        m = _scanner.match(cont, pos)
+        assert m, "One regex must match. %s... unmatched" % (repr(cont[pos:pos+20]),)
+        regex, action = _rules[m.lastindex]
+        end = m.end()
+        assert end > pos
+        if action:
+            # Match again on its own, so that the action gets its groups
+            # numbered from 1
+            gen = action(regex.match(cont, pos), state, filestate)
+        else:
+            if state['ifdef']: gen = m.group(0)
+            else:              gen = ""
+        if type(gen) is str:
+            if gen:
+                if resync:
+                    anchor = _resume(state, filestate)
+                    if anchor: yield anchor
+                    resync = False
+                yield gen
+            if len(gen) != end - pos:
+                # We have removed text
+                resync = True
+        else:
+            # An included file or expanded macro, streamed through
+            # piece by piece
+            if resync:
+                anchor = _resume(state, filestate)
+                if anchor: yield anchor
+                resync = False
+            yield from gen
+            resync = True
+        filestate['char']   += end - pos
+        filestate['lineno'] += cont.count('\n', pos, end)
+        pos = end
 
 if __name__ == "__main__":
     import sys
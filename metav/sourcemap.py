@@ -0,0 +1,118 @@
+# This file is part of metav.
+
+# metav is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# metav is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with metav.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Mapping of offsets in preprocessed text back to the source"""
+
+import array
+import bisect
+import itertools
+
+class SourceMap(object):
+    """Where each part of a preprocessed text came from
+
+    A source is a file or the body of a macro. Every file read and
+    every macro expanded gets a context, (parent context, offset in
+    parent, type, name), where the parent is the context it was
+    included or expanded from, or -1.
+
+    The text is cut in segments, copied verbatim from one context
+    each. Segment i starts at starts[i] in the text and offsets[i] in
+    the source of context ctxs[i].
+
+    Positions are given as pos_stack tuples of
+    (type, name, offset, line, column), outermost first."""
+    def __init__(self):
+        self.contexts = []
+        self.starts = array.array('Q')
+        self.offsets = array.array('Q')
+        self.ctxs = array.array('l')
+        self.size = 0
+        self.sources = {}
+        self._lines = {}
+        self._hints = {}
+        self._outer = {}
+
+    def context(self, parent, offset, type_, name):
+        "Add a context, and return its number"
+        self.contexts.append((parent, offset, type_, name))
+        return len(self.contexts) - 1
+
+    def segment(self, ctx, offset, start=None):
+        """Let the text from start, by default the end of the text so
+        far, come from offset in the source of ctx"""
+        if start is None:
+            start = self.size
+        if self.starts and self.starts[-1] == start:
+            # The previous segment turned out empty
+            self.offsets[-1] = offset
+            self.ctxs[-1] = ctx
+            return
+        self.starts.append(start)
+        self.offsets.append(offset)
+        self.ctxs.append(ctx)
+
+    def source(self, type_, name, text):
+        "Register the text of a source that cannot be read back from file"
+        self.sources[(type_, name)] = text
+
+    def locate(self, pos):
+        "Return (context, offset) of position pos in the text"
+        i = bisect.bisect_right(self.starts, pos) - 1
+        assert i >= 0, "position %d is before the first segment" % pos
+        return self.ctxs[i], self.offsets[i] + pos - self.starts[i]
+
+    def position(self, pos):
+        "Return the pos_stack of position pos in the text"
+        return self.stack(*self.locate(pos))
+
+    def stack(self, ctx, offset):
+        "Return the pos_stack of offset in the source of ctx"
+        if ctx < 0:
+            return ()
+        parent, parent_offset, type_, name = self.contexts[ctx]
+        outer = self._outer.get(ctx)
+        if outer is None:
+            # The same for every position in ctx
+            outer = self._outer[ctx] = self.stack(parent, parent_offset)
+        line, column = self.linecol(type_, name, offset)
+        return outer + ((type_, name, offset, line, column),)
+
+    def linecol(self, type_, name, offset):
+        "Return line (from 1) and column (from 0) of offset in a source"
+        key = (type_, name)
+        starts = self._lines.get(key)
+        if starts is None:
+            starts = self._lines[key] = self.line_index(type_, name)
+        # Positions are mostly asked for in order, so try the line of
+        # the last one before bisecting
+        line = self._hints.get(key, 1)
+        if offset < starts[line - 1] or \
+           (line < len(starts) and offset >= starts[line]):
+            line = bisect.bisect_right(starts, offset)
+            self._hints[key] = line
+        return line, offset - starts[line - 1]
+
+    def line_index(self, type_, name):
+        "Return the offsets where the lines of a source start"
+        text = self.sources.get((type_, name))
+        if text is None:
+            if type_ == 'file':
+                with open(name) as f:
+                    text = f.read()
+            else:
+                # Macros are defined on one line
+                text = ''
+        return array.array('I', itertools.accumulate(
+            (len(l) + 1 for l in text.split('\n')[:-1]), initial=0))
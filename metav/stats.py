@@ -0,0 +1,171 @@
+# This file is part of metav.
+
+# metav is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# metav is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with metav.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time spent in the phases of a run, and counts of what was done
+
+Nothing is measured until enable() is called:
+
+    metav.stats.enable()
+    ... process ...
+    print(metav.stats.summary())
+
+The time of a phase is its own, without that of phases inside it, so
+the phases add up to the time measured. The time of a metav block is
+all of it, with the modules it processes.
+
+When disabled, phase() returns the same do-nothing context manager,
+and counting is a test of enabled."""
+
+import time
+import threading
+import collections
+
+enabled = False
+
+_lock = threading.Lock()
+_local = threading.local()
+_phases = {}
+_blocks = {}
+_counters = collections.Counter()
+
+class _Null(object):
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+
+_null = _Null()
+
+class _Phase(object):
+    def __init__(self, name, block):
+        self.name = name
+        self.block = block
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append(self)
+        self.inner_wall = self.inner_cpu = 0.0
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.wall
+        cpu = time.thread_time() - self.cpu
+        stack = _local.stack
+        stack.pop()
+        if stack:
+            stack[-1].inner_wall += wall
+            stack[-1].inner_cpu += cpu
+        with _lock:
+            t = _phases.setdefault(self.name, [0, 0.0, 0.0])
+            t[0] += 1
+            t[1] += wall - self.inner_wall
+            t[2] += cpu - self.inner_cpu
+            if self.block is not None:
+                b = _blocks.setdefault(self.block, [0, 0.0])
+                b[0] += 1
+                b[1] += wall
+        return False
+
+def phase(name, block=None):
+    """Return a context manager timing what is done in it as phase
+    name, and as block, if given, of those timed one by one"""
+    if not enabled:
+        return _null
+    return _Phase(name, block)
+
+def count(name, n=1):
+    "Add n to counter name"
+    if enabled:
+        with _lock:
+            _counters[name] += n
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+def reset():
+    with _lock:
+        _phases.clear()
+        _blocks.clear()
+        _counters.clear()
+
+def report():
+    """Return what was measured, as
+    {'phases': {name: {'calls', 'wall', 'cpu'}},
+     'blocks': {name: {'calls', 'wall'}},
+     'counters': {name: n}}"""
+    with _lock:
+        return {
+            'phases': dict((name, {'calls': t[0], 'wall': t[1], 'cpu': t[2]})
+                           for name, t in _phases.items()),
+            'blocks': dict((name, {'calls': b[0], 'wall': b[1]})
+                           for name, b in _blocks.items()),
+            'counters': dict(_counters),
+            }
+
+def merge(other):
+    "Add a report from another process"
+    with _lock:
+        for name, t in other['phases'].items():
+            mine = _phases.setdefault(name, [0, 0.0, 0.0])
+            mine[0] += t['calls']
+            mine[1] += t['wall']
+            mine[2] += t['cpu']
+        for name, b in other['blocks'].items():
+            mine = _blocks.setdefault(name, [0, 0.0])
+            mine[0] += b['calls']
+            mine[1] += b['wall']
+        _counters.update(other['counters'])
+
+def _rate(counters, name):
+    hits = counters.get(name + '_hits', 0)
+    misses = counters.get(name + '_misses', 0)
+    if hits + misses == 0:
+        return None
+    return hits, hits + misses
+
+def summary(stats=None, blocks=10):
+    "Return report(), or stats, as text, with the slowest blocks"
+    if stats is None:
+        stats = report()
+    lines = ["%-12s %8s %10s %10s" % ("phase", "calls", "wall s", "cpu s")]
+    phases = stats['phases']
+    for name in sorted(phases, key=lambda n: -phases[n]['wall']):
+        t = phases[name]
+        lines.append("%-12s %8d %10.3f %10.3f" % (name, t['calls'], t['wall'],
+                                                  t['cpu']))
+    lines.append("%-12s %8s %10.3f %10.3f" % (
+            "total", "", sum(t['wall'] for t in phases.values()),
+            sum(t['cpu'] for t in phases.values())))
+    counters = stats['counters']
+    for name in sorted(counters):
+        if not name.endswith('_hits') and not name.endswith('_misses'):
+            lines.append("%-24s %10d" % (name, counters[name]))
+    for name in ('include_cache', 'ast_cache', 'module_cache',
+                 'design_table'):
+        rate = _rate(counters, name)
+        if rate is not None:
+            lines.append("%-24s %10s %5.1f%%" % (
+                    name + " hits", "%d/%d" % rate, 100.0 * rate[0] / rate[1]))
+    slowest = sorted(stats['blocks'].items(), key=lambda b: -b[1]['wall'])
+    if slowest and blocks:
+        lines.append("%-40s %8s %10s" % ("metav block", "calls", "wall s"))
+        for name, b in slowest[:blocks]:
+            lines.append("%-40s %8d %10.3f" % (name, b['calls'], b['wall']))
+    return '\n'.join(lines)
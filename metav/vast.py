@@ -16,20 +16,106 @@
 """Objects for constructing a Verilog Abstract Syntax Tree (vast)"""
 
 import metav.literal
+import metav.stats
 import ast
-
-def _get_end(i):
-    "Given a pos_stack, calculate the position + length of identifier"
-    last = i.pos_stack[-1]
-    off = len(str(i.value))
-    return i.pos_stack[:1] + \
-        ((last[0], last[1], last[2] + off, last[3], last[4] + off),)
+import sys
+import contextlib
+import collections
+
+# If true, the ids of a Module are checked against building them all
+# again after each change. For debugging.
+check_ids = False
+
+def _start(x):
+    """Return where x, a token or a node, starts, as (source map,
+    context, offset), or (None, pos_stack) for a node without one"""
+    if isinstance(x, Ast):
+        if x._sourcemap is None:
+            return None, x._span[0]
+        return x._sourcemap, x._span[0], x._span[1]
+    ctx, offset = x.location
+    return x.lexer.sourcemap, ctx, offset
+
+def _stop(x):
+    "Return where x, a token or a node, ends, as _start does"
+    if isinstance(x, Ast):
+        if x._sourcemap is None:
+            return None, x._span[1]
+        return x._sourcemap, x._span[-2 if len(x._span) == 4 else 0], \
+            x._span[-1]
+    ctx, offset = x.location
+    return x.lexer.sourcemap, ctx, offset + len(str(x.value))
+
+def _stack(where):
+    "Return the pos_stack of where, as given by _start or _stop"
+    if where[0] is None:
+        return where[1]
+    return where[0].stack(where[1], where[2])
+
+def _is_token(x):
+    return hasattr(x, 'lexpos')
+
+def _has_pos(x):
+    return getattr(x, '_span', None) is not None
+
+def _slots(node):
+    "Return the slots of node that are set, by name"
+    state = {}
+    for cls in type(node).__mro__:
+        for name in cls.__dict__.get('__slots__', ()):
+            if hasattr(node, name):
+                state[name] = getattr(node, name)
+    return state
 
 class Ast(object):
-    """Superclass to all nodes in the syntax tree"""
+    """Superclass to all nodes in the syntax tree
+
+    Nodes keep their attributes in slots, as there are many of them,
+    with slots for parent, edit_plan and instruction as well. Other
+    attributes can only be set on Module and Metav.
+
+    The position of a node is kept as (context, begin offset, end
+    offset) in its source map, or (begin context, begin offset, end
+    context, end offset) if it ends in another context. pos gives it
+    as (begin pos_stack, end pos_stack), looked up when asked for.
+
+    _fields names the attributes holding the children of a node, each
+    a node, a list of nodes or None, in the order of the source."""
+    __slots__ = ('parent', 'edit_plan', 'instruction', '_sourcemap', '_span')
+    _fields = ()
+
+    @property
+    def pos(self):
+        sourcemap = self._sourcemap
+        span = self._span
+        if sourcemap is None:
+            return span
+        if len(span) == 3:
+            return (sourcemap.stack(span[0], span[1]),
+                    sourcemap.stack(span[0], span[2]))
+        return (sourcemap.stack(span[0], span[1]),
+                sourcemap.stack(span[2], span[3]))
+
+    @pos.setter
+    def pos(self, pos):
+        self._sourcemap = None
+        self._span = pos
+
+    def _set_pos(self, begin, end):
+        "Let the node go from begin to end, as given by _start and _stop"
+        sourcemap = begin[0]
+        if sourcemap is None or end[0] is not sourcemap:
+            self.pos = (_stack(begin), _stack(end))
+            return
+        self._sourcemap = sourcemap
+        if begin[1] == end[1]:
+            self._span = (begin[1], begin[2], end[2])
+        else:
+            self._span = (begin[1], begin[2], end[1], end[2])
+
     def extend_pos(self, end):
         "Update the position of the AST element by extending the end"
-        self.pos = (self.pos[0], _get_end(end))
+        self._set_pos(_start(self), _stop(end))
     def delete_child(self, child):
         "Delete a child from the AST. To be called from child in child.delete()"
         # To be overridden if it makes sense
@@ -62,9 +148,23 @@ class Module(Ast):
               the AST for the instanciated modules
      * ids: A dict(identifier name -> set(Decl)) of declarations
             found in the module. Ports and parameters are found here.
+     * files: (filename, mtime_ns, size) of the files the module was
+              preprocessed from, as they were before they were read,
+              if it was processed by process.py or metav.design, else
+              None
+
+    Many items are best added with add_items, or add_item inside
+    "with module.batch():", which inserts them in one metav_generated
+    block, and deleted with delete_items, or delete() inside it, which
+    takes them out in one pass. Outside a batch each delete searches
+    for the child.
     """
+    _fields = ('name', 'modparams', 'modports', 'items')
+    _batch = None
+    files = None
+
     def __init__(self, module, name, modparams, modports, items, endmodule):
-        self.pos = (module.pos_stack, _get_end(endmodule))
+        self._set_pos(_start(module), _stop(endmodule))
         self.append_pos = endmodule.pos_stack
         self.is_root_node = True
         assert isinstance(name, Id)
@@ -82,31 +182,41 @@ class Module(Ast):
 
     def execute_metav(self, get_module, includes):
         for m in self.metav:
-            exec(m.code, {'module':     self,
-                          'get_module': get_module,
-                          'ast':        metav.vast,
-                          'includes':   includes,
-                          })
+            with metav.stats.phase('metav', "%s:%d" % (m.filename,
+                                                       m.first_line)):
+                exec(m.code, {'module':     self,
+                              'get_module': get_module,
+                              'ast':        metav.vast,
+                              'includes':   includes,
+                              })
 
     def _build_ids(self):
-        self.ids = {}
-        self._extract_modparams()
-        self._extract_modports()
-        self._extract_declarations()
-        # Identify "output reg" declarations, and index them as
-        # one output declaration and one reg declaration
-        self._extract_output_reg()
-
+        with metav.stats.phase('build_ids'):
+            self.ids = {}
+            self._extract_modparams()
+            self._extract_modports()
+            self._extract_declarations()
+            # Identify "output reg" declarations, and index them as
+            # one output declaration and one reg declaration
+            self._extract_output_reg()
+
+
+    @staticmethod
+    def _declared(i):
+        "Return the ids or assigns item i declares, or None"
+        if hasattr(i, 'ids'):          return i.ids
+        elif hasattr(i, 'ids_or_mem'): return i.ids_or_mem
+        elif type(i) == Wire:          return i.ids_or_assigns
+        elif type(i) == Parameter:     return i.assigns
+        return None
 
     def _extract_declarations(self):
         for i in self.items:
             assert isinstance(i, Ast), "'%r' is not Ast" % i
             i.parent = self
-            if hasattr(i, 'ids'):          ids = i.ids
-            elif hasattr(i, 'ids_or_mem'): ids = i.ids_or_mem
-            elif type(i) == Wire:          ids = i.ids_or_assigns
-            elif type(i) == Parameter:     ids = i.assigns
-            else:                          continue
+            ids = self._declared(i)
+            if ids is None:
+                continue
             if isinstance(i, Port):
                 if self.portstyle not in (None, "regular"):
                     raise Exception("Not coherent portstyle at %r" % i)
@@ -154,10 +264,69 @@ class Module(Ast):
                 o = decl.ast
                 assert decl.id.value == id_
                 if o.is_reg:
-                    regdecl = self.Decl(Reg([decl.id], o.range),
-                                        decl.id)
-                    to_add.add(regdecl)
+                    to_add.add(self._output_reg(decl))
             self.ids[id_].update(to_add)
+
+    def _output_reg(self, decl):
+        "Return the reg declaration of decl, an output reg"
+        regdecl = self.Decl(Reg([decl.id], decl.ast.range), decl.id)
+        regdecl.output = decl.ast
+        return regdecl
+
+    def _add_ids(self, item):
+        "Add the declarations of item, a new item, to ids"
+        item.parent = self
+        ids = self._declared(item)
+        if ids is None:
+            return
+        if isinstance(item, Port):
+            if self.portstyle not in (None, "regular"):
+                raise Exception("Not coherent portstyle at %r" % item)
+            self.portstyle = "regular"
+        for id_or_assign in ids:
+            if type(id_or_assign) == Assign:
+                name = id_or_assign.lval.value
+            else:
+                name = id_or_assign.value
+            decl = self.Decl(item, id_or_assign)
+            decls = self.ids.setdefault(name, set())
+            decls.add(decl)
+            if decl.type == 'port' and decl.subtype == 'output' and item.is_reg:
+                decls.add(self._output_reg(decl))
+
+    def _remove_ids(self, child):
+        "Remove the declarations of child, an item, modport or modparam"
+        ids = self._declared(child)
+        if ids is None:
+            return
+        for id_or_assign in ids:
+            if type(id_or_assign) == Assign:
+                name = id_or_assign.lval.value
+            else:
+                name = id_or_assign.value
+            decls = self.ids.get(name)
+            if decls is None:
+                continue
+            decls = set(d for d in decls if d.ast is not child and
+                        getattr(d, 'output', None) is not child)
+            if decls:
+                self.ids[name] = decls
+            else:
+                del self.ids[name]
+
+    def _check_ids(self):
+        "Assert that ids is what building it all again gives"
+        def signature(ids):
+            return dict((name, sorted((d.type, getattr(d, 'subtype', None),
+                                       id(d.id),
+                                       id(getattr(d, 'output', d.ast)))
+                                      for d in decls))
+                        for name, decls in ids.items())
+        ids = self.ids
+        self._build_ids()
+        assert signature(ids) == signature(self.ids), \
+            "ids of module %s differ from a full build" % self.name.value
+        self.ids = ids
         
     class Decl(object):
         def __init__(self, ast, id_):
@@ -213,16 +382,21 @@ class Module(Ast):
         self._make_edit_plan()
         item.parent = self
         self.items.append(item)
+        if self._batch is not None:
+            self._batch['added'][id(item)] = item
+            return
         instruction = ('insert', self.append_pos,  item)
         item.instruction = instruction
         self.edit_plan.append(instruction)
-        self._build_ids()
+        self._add_ids(item)
+        if check_ids:
+            self._check_ids()
     def add_port(self, port):
         assert isinstance(port, Port)
         self._make_edit_plan()
         if self.portstyle == "regular":
             pass
-        elif self.portstyle = "ansi":
+        elif self.portstyle == "ansi":
             pass
         else:
             assert False, "Unknown portstyle %r" % self.portstyle
@@ -232,41 +406,181 @@ class Module(Ast):
         raise NotImplementedError
 
     def delete_child(self, child):
-        # First, check if it is a module item
-        for n, item in enumerate(self.items):
-            if item is child:
-                del self.items[n]
-                self._build_ids()
-                return
-
-        # If it is not a module item, check if it is a modport
-        for n, modport in enumerate(self.modports):
-            if modport is child:
-                del self.modports[n]
-                self._build_ids()
-                return
-
-        # If not item or modport, maybe modparam?
-        for n, modparam in enumerate(self.modparams):
-            if modparam is child:
-                del self.modparams[n]
-                self._build_ids()
-                return
+        if self._batch is not None:
+            # Taken out with the others when the batch is left
+            self._batch['gone'][id(child)] = child
+            self._deleted(child)
+            return
+        # A module item, a modport or a modparam. Nodes are only equal
+        # to themselves, so index finds child itself
+        for children in (self.items, self.modports, self.modparams):
+            try:
+                n = children.index(child)
+            except (ValueError, AttributeError):
+                continue
+            del children[n]
+            self._deleted(child)
+            return
 
         assert False, "Could not find child "+repr(child)
-    
+
+    def _deleted(self, child):
+        if self._batch is not None:
+            if self._batch['added'].pop(id(child), None) is None:
+                self._batch['removed'].append(child)
+            return
+        self._remove_ids(child)
+        if check_ids:
+            self._check_ids()
+
+    def add_items(self, items):
+        "Add each of items, in one metav_generated block"
+        with self.batch():
+            for item in items:
+                self.add_item(item)
+
+    def delete_items(self, items):
+        "Delete each of items, in one batch"
+        with self.batch():
+            for item in items:
+                item.delete()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Return a context manager in which the items added are
+        inserted together, after those added before, in one
+        metav_generated block. Deleted children are taken out of items,
+        modports and modparams together, in one pass instead of a
+        search for each, and ids is brought up to date, when it is left,
+        not with each change. Deleting many items is best done in one.
+
+        If it is left with an exception, nothing is made of the batch:
+        the items added are taken out again, and the children deleted
+        are put back, with their removal taken out of the edit plan."""
+        if self._batch is not None:
+            # Part of the batch around it
+            yield self
+            return
+        self._batch = {'added': {}, 'removed': [], 'gone': {}}
+        # Items are only added at the end of items, and nothing is
+        # taken out before the batch is left
+        length = len(self.items)
+        try:
+            yield self
+        except BaseException:
+            batch, self._batch = self._batch, None
+            self._discard(batch, length)
+            raise
+        batch, self._batch = self._batch, None
+        self._commit(batch, length)
+
+    def _commit(self, batch, length):
+        "Make the changes of batch, left without an exception"
+        gone = batch['gone']
+        if gone:
+            kept = []
+            found = 0
+            for children in (self.items, self.modports, self.modparams):
+                if children:
+                    kept.append([c for c in children if id(c) not in gone])
+                    found += len(children) - len(kept[-1])
+            if found != len(gone):
+                self._discard(batch, length)
+                raise ValueError("Not all of %r are children of module %s" %
+                                 (list(gone.values()), self.name.value))
+            for children in (self.items, self.modports, self.modparams):
+                if children:
+                    children[:] = kept.pop(0)
+        for child in batch['removed']:
+            self._remove_ids(child)
+        added = GeneratedItems(batch['added'].values())
+        if added:
+            instruction = ('insert', self.append_pos, added)
+            for item in added:
+                item.instruction = instruction
+                self._add_ids(item)
+            self.edit_plan.append(instruction)
+        if check_ids:
+            self._check_ids()
+
+    def _discard(self, batch, length):
+        """Undo what was done in batch, left with an exception: take the
+        items added out again, and put the children deleted back"""
+        added = set(id(item) for item in self.items[length:])
+        for item in self.items[length:]:
+            item.parent = None
+        del self.items[length:]
+        removes = set()
+        for child in batch['gone'].values():
+            if id(child) not in added:
+                child.parent = self
+            if _has_pos(child):
+                removes.add(('remove',) + child.pos)
+        if removes:
+            self.edit_plan[:] = [i for i in self.edit_plan
+                                 if i[0] != 'remove' or i not in removes]
+
+class GeneratedItems(list):
+    "Items inserted together by Module.batch"
+    def __str__(self):
+        return '\n'.join(str(x) for x in self)
+
+class LazyModule(Module):
+    """A Module of which only the header and the port and parameter
+    declarations are parsed, as by metav.parse.parse_header
+
+    The first time items, insts or metav is used, load(module) is
+    called to parse the rest. It is expected to call set_body."""
+    def __init__(self, header, load):
+        self.__dict__.update(header.__dict__)
+        for name, value in _slots(header).items():
+            setattr(self, name, value)
+        for x in (self.modparams or []) + (self.modports or []) + self.items:
+            x.parent = self
+        del self.items, self.insts, self.metav
+        self._load = load
+
+    def __getattr__(self, name):
+        if name not in ('items', 'insts', 'metav') or '_load' not in self.__dict__:
+            raise AttributeError(name)
+        self.__dict__.pop('_load')(self)
+        return getattr(self, name)
+
+    def set_body(self, module):
+        "Take everything from module, the same module fully parsed"
+        self.__dict__.update(module.__dict__)
+        for name, value in _slots(module).items():
+            setattr(self, name, value)
+        self._build_ids()
+
 class Metav(Ast):
     def __init__(self, from_lex):
         source, filename, first_line = from_lex
-        parsed_ast = ast.parse(source, filename)
-        ast.increment_lineno(parsed_ast, first_line)
-        code = compile(parsed_ast, filename=filename, mode='exec')
         self.source = source
-        self.code = code
+        self.filename = filename
+        self.first_line = first_line
+        self._compile()
+    def _compile(self):
+        parsed_ast = ast.parse(self.source, self.filename)
+        ast.increment_lineno(parsed_ast, self.first_line)
+        self.code = compile(parsed_ast, filename=self.filename, mode='exec')
+    def __getstate__(self):
+        # Code objects can't be pickled, so compile it again when loaded
+        state = dict(self.__dict__)
+        del state['code']
+        return state, _slots(self)
+    def __setstate__(self, state):
+        state, slots = state
+        self.__dict__.update(state)
+        for name, value in slots.items():
+            setattr(self, name, value)
+        self._compile()
     def __str__(self):
         return "/*metav\n%s\n\t*/" % self.source
 
 class Port(Ast):
+    __slots__ = ('ids', 'range', 'in_portlist')
+    _fields = ('range', 'ids')
     def __init__(self, ids, range=None):
         if type(ids) is not list:
             ids = [ids]
@@ -281,13 +595,13 @@ class Port(Ast):
 
     def parse_info(self, kw, in_portlist=False):
         last = self.ids[-1]
-        self.pos = (kw.pos_stack, last.pos[1])
+        self._set_pos(_start(kw), _stop(last))
         assert self.type == kw.value
         self.in_portlist = in_portlist
     def append(self, id_):
         self.ids.append(id_)
         id_.parent = self
-        self.pos = (self.pos[0], id_.pos[1])
+        self._set_pos(_start(self), _stop(id_))
     def __str__(self):
         ret = self.type + " "
         if self.range: ret += str(self.range) + " "
@@ -297,17 +611,22 @@ class Port(Ast):
 
 
 class Input(Port):
+    __slots__ = ()
     type = "input"
 class Output(Port):
+    __slots__ = ('reg_kw', 'is_reg')
     type = "output"
     def __init__(self, ids, range=None, reg=None):
         Port.__init__(self, ids, range=range)
         self.reg_kw = reg
         self.is_reg = getattr(reg, 'value', None) == "reg"
 class Inout(Port):
+    __slots__ = ()
     type = "inout"
 
 class Range(Ast):
+    __slots__ = ('msb', 'lsb')
+    _fields = ('msb', 'lsb')
     def __init__(self, msb, lsb):
         assert isinstance(msb, Expression)
         assert isinstance(lsb, Expression)
@@ -316,24 +635,28 @@ class Range(Ast):
         msb.parent = self
         lsb.parent = self
     def parse_info(self, left, right):
-        self.pos = (left.pos_stack, _get_end(right))
+        self._set_pos(_start(left), _stop(right))
         
     def __str__(self):
         return "["+str(self.msb)+":"+str(self.lsb)+"]"
 
 class ContAssigns(Ast):
+    __slots__ = ('assigns',)
+    _fields = ('assigns',)
     def __init__(self, assigns):
         self.assigns = assigns
         for a in assigns:
             a.parent = self
     def parse_info(self, kw):
         last = self.assigns[-1]
-        self.pos = (kw.pos_stack, last.pos[1])
+        self._set_pos(_start(kw), _stop(last))
         
     def __str__(self, ntabs = 0):
         return "assign\n" + '\n'.join(x.__str__(ntabs + 1) for x in self.assigns) + ";"
 
 class Parameter(Ast):
+    __slots__ = ('type', 'range', 'assigns')
+    _fields = ('range', 'assigns')
     def __init__(self, assigns, type="parameter", range=None):
         self.type = type
         self.range = range
@@ -348,18 +671,20 @@ class Parameter(Ast):
             a.parent = self
 
     def parse_info(self, type_kw):
-        self.pos = (type_kw.pos_stack, self.assigns[-1].pos[1])
+        self._set_pos(_start(type_kw), _stop(self.assigns[-1]))
         self.type = type_kw.value
         
     def append(self, assign):
         self.assigns.append(assign)
         assign.parent = self
-        self.pos = (self.pos[0], assign.pos[1])
+        self._set_pos(_start(self), _stop(assign))
     def __str__(self):
         return self.type + " " + \
             ',\n\t\t'.join(str(x) for x in self.assigns) + ";"
 
 class Wire(Ast):
+    __slots__ = ('range', 'ids_or_assigns')
+    _fields = ('range', 'ids_or_assigns')
     def __init__(self, ids_or_assigns, range=None):
         self.range = range
         if self.range:
@@ -370,7 +695,7 @@ class Wire(Ast):
             i.parent = self
     def parse_info(self, kw):
         last = self.ids_or_assigns[-1]
-        self.pos = (kw.pos_stack, last.pos[1])
+        self._set_pos(_start(kw), _stop(last))
         
     def __str__(self):
         r = ""
@@ -381,6 +706,8 @@ class Wire(Ast):
         return ret
 
 class Reg(Ast):
+    __slots__ = ('range', 'ids_or_mem')
+    _fields = ('range', 'ids_or_mem')
     def __init__(self, ids_or_mem, range=None):
         self.range = range
         if self.range:
@@ -392,7 +719,7 @@ class Reg(Ast):
 
     def parse_info(self, kw):
         last = self.ids_or_mem[-1]
-        self.pos = (kw.pos_stack, last.pos[1])
+        self._set_pos(_start(kw), _stop(last))
         
     def __str__(self):
         r = ""
@@ -404,10 +731,12 @@ class Reg(Ast):
         return "reg " + r + ",\n\t\t".join(s(x) for x in self.ids_or_mem) + ";"
 
 class MemReg(Ast):
+    __slots__ = ('id', 'range', 'value')
+    _fields = ('id', 'range')
     def __init__(self, id_, range_):
         assert isinstance(id_, Id)
-        if hasattr(id_, 'pos'):
-            self.pos = (id_.pos[0], range_.pos[1])
+        if _has_pos(id_):
+            self._set_pos(_start(id_), _stop(range_))
         self.id = id_
         self.id.parent = self
         self.range = range_
@@ -418,19 +747,23 @@ class MemReg(Ast):
         return self.value + " "+str(self.range)
 
 class Always(Ast):
+    __slots__ = ('statement',)
+    _fields = ('statement',)
     def __init__(self, statement):
         self.statement = statement
         self.statement.parent = self
     def parse_info(self, kw):
-        self.pos = (kw.pos_stack, self.statement.pos[1])
+        self._set_pos(_start(kw), _stop(self.statement))
         
     def __str__(self):
         return "always\n" + self.statement.__str__(2)
 
 class Edge(Ast):
+    __slots__ = ('polarity', 'signal')
+    _fields = ('signal',)
     def __init__(self, polarity, signal):
-        if hasattr(polarity, 'pos_stack'):
-            self.pos = (polarity.pos_stack, signal.pos[1])
+        if _is_token(polarity):
+            self._set_pos(_start(polarity), _stop(signal))
             self.polarity = polarity.value
         else:
             self.polarity = polarity
@@ -440,9 +773,12 @@ class Edge(Ast):
         return str(self.polarity) + " " + self.signal.value
 
 class ModuleInsts(Ast):
+    __slots__ = ('module_name', 'block_comment', 'param_overrides', 'insts',
+                 'module', '_get_module')
+    _fields = ('module_name', 'param_overrides', 'insts')
     def __init__(self, module_name, param_overrides, insts):
-        if hasattr(module_name, "pos"):
-            self.pos = (module_name.pos[0], insts[-1].pos[1])
+        if _has_pos(module_name):
+            self._set_pos(_start(module_name), _stop(insts[-1]))
         assert isinstance(module_name, Id)
         self.module_name = module_name
         self.block_comment = module_name.block_comment
@@ -474,6 +810,8 @@ class ModuleInsts(Ast):
         return ret
 
 class ModuleInst(Ast):
+    __slots__ = ('inst_name', 'connections')
+    _fields = ('inst_name', 'connections')
     def __init__(self, inst_name, connections):
         self.inst_name = inst_name
         self.inst_name.parent = self
@@ -481,25 +819,29 @@ class ModuleInst(Ast):
         for c in connections:
             c.parent = self
     def parse_info(self, right):
-        self.pos = (self.inst_name.pos[0], _get_end(right))
+        self._set_pos(_start(self.inst_name), _stop(right))
         
     def __str__(self):
         return self.inst_name.value + \
             ' (' + ',\n\t\t\t'.join(str(x) for x in self.connections) + ")"
 
 class Connection(Ast):
+    __slots__ = ('id', 'expr')
+    _fields = ('id', 'expr')
     def __init__(self, id_, expr):
         self.id = id_
         self.id.parent = self
         self.expr = expr
         self.expr.parent = self
     def parse_info(self, dot, right):
-        self.pos = (dot.pos_stack, _get_end(right))
+        self._set_pos(_start(dot), _stop(right))
         
     def __str__(self):
         return "."+self.id.value+'('+str(self.expr)+')'
 
 class FunctionDeclaration(Ast):
+    __slots__ = ('automatic', 'range_opt', 'name', 'declarations', 'statement')
+    _fields = ('range_opt', 'name', 'declarations', 'statement')
     def __init__(self, automatic, range_opt, name, declarations, statement):
         assert isinstance(automatic, bool)
         assert isinstance(range_opt, (type(None), Range))
@@ -519,7 +861,7 @@ class FunctionDeclaration(Ast):
             d.parent = self
         statement.parent = self
     def parse_info(self, function, endfunction):
-        self.pos = (function.pos_stack, _get_end(endfunction))
+        self._set_pos(_start(function), _stop(endfunction))
     def __str__(self):
         auto = "automatic " if self.automatic else ""
         range = str(self.range_opt) + " " if self.range_opt else ""
@@ -529,16 +871,18 @@ class FunctionDeclaration(Ast):
             + "\n\tendfunction"
 
 class Statement(Ast):
-    pass
+    __slots__ = ()
 
 class Case(Statement):
+    __slots__ = ('expr', 'items', 'type')
+    _fields = ('expr', 'items')
     def __init__(self, expr, items, type="case"):
         self.expr = expr
         self.items = items
         self.type = type
         assert type in ("case", "casez", "casex")
     def parse_info(self, kw, endcase):
-        self.pos = (kw.pos_stack, endcase.pos_stack)
+        self._set_pos(_start(kw), _start(endcase))
         self.type = kw.value
         
     def __str__(self, ntabs=0):
@@ -548,20 +892,22 @@ class Case(Statement):
         return ret
 
 class CaseItem(Ast):
+    __slots__ = ('expressions', 'statement')
+    _fields = ('expressions', 'statement')
     def __init__(self, expressions, statement):
         if type(expressions) in (list, tuple):
-            pos0 = expressions[0].pos[0]
+            pos0 = _start(expressions[0])
             self.expressions = expressions
         else:
             # default case:
-            pos0 = expressions.pos_stack
+            pos0 = _start(expressions)
             self.expressions = None
         if isinstance(statement, Statement):
             self.statement = statement
-            self.pos = (pos0, statement.pos[1])
+            self._set_pos(pos0, _stop(statement))
         else:
             self.statement = None
-            self.pos = (pos0, statement.pos_stack)
+            self._set_pos(pos0, _start(statement))
     def __str__(self, ntabs=0):
         ret = "\t" * ntabs
         if self.expressions:
@@ -575,9 +921,11 @@ class CaseItem(Ast):
         return ret
 
 class Assign(Statement):
+    __slots__ = ('lval', 'op', 'rval', 'is_statement')
+    _fields = ('lval', 'rval')
     def __init__(self, lval, op, rval, is_statement = False):
-        if hasattr(lval, 'pos'):
-            self.pos = (lval.pos[0], rval.pos[1])
+        if _has_pos(lval):
+            self._set_pos(_start(lval), _stop(rval))
         self.lval = lval
         self.lval.parent = self
         self.op = op
@@ -592,6 +940,8 @@ class Assign(Statement):
         return ret
         
 class At(Statement):
+    __slots__ = ('sens', 'statement')
+    _fields = ('sens', 'statement')
     def __init__(self, sens, statement):
         self.sens = sens
         if sens:
@@ -599,7 +949,7 @@ class At(Statement):
         self.statement = statement
         self.statement.parent = self
     def parse_info(self, at):
-        self.pos = (at.pos_stack, self.statement.pos[1])
+        self._set_pos(_start(at), _stop(self.statement))
     def __str__(self, ntabs=0):
         sens = self.sens
         if not sens: sens = "*"
@@ -607,6 +957,8 @@ class At(Statement):
         return "\t" * ntabs + "@(" + sens + ")\n" + self.statement.__str__(ntabs + 1)
 
 class If(Statement):
+    __slots__ = ('cond', 'true', 'false')
+    _fields = ('cond', 'true', 'false')
     def __init__(self, cond, true, false):
         self.cond = cond
         self.cond.parent = self
@@ -616,8 +968,7 @@ class If(Statement):
         if self.false:
             self.false.parent = self
     def parse_info(self, kw):
-        self.pos = (kw.pos_stack,
-                    self.false.pos[1] if self.false else self.true.pos[1])
+        self._set_pos(_start(kw), _stop(self.false if self.false else self.true))
         
     def __str__(self, ntabs=0):
         ret = "\t" * ntabs + "if ( " + str(self.cond) + " )\n" + self.true.__str__(ntabs + 1)
@@ -626,6 +977,8 @@ class If(Statement):
         return ret
 
 class For(Statement):
+    __slots__ = ('init', 'cond', 'incr', 'statement')
+    _fields = ('init', 'cond', 'incr', 'statement')
     def __init__(self, init, cond, incr, statement):
         self.init = init
         init.parent = self
@@ -636,30 +989,34 @@ class For(Statement):
         self.statement = statement
         statement.parent = self
     def parse_info(self, for_):
-        self.pos = (for_.pos_stack, self.statement.pos[1])
+        self._set_pos(_start(for_), _stop(self.statement))
     def __str__(self, ntabs = 0):
         return "\t" * ntabs + "for (" + str(self.init) + "; " + \
             str(self.cond) + "; " + str(self.incr) + ")\n" + \
             self.statement.__str__(ntabs + 1)
 
 class While(Statement):
+    __slots__ = ('cond', 'statement')
+    _fields = ('cond', 'statement')
     def __init__(self, cond, statement):
         self.cond = cond
         cond.parent = self
         self.statement = statement
         statement.parent = self
     def parse_info(self, while_):
-        self.pos = (while_.pos_stack, self.statement.pos[1])
+        self._set_pos(_start(while_), _stop(self.statement))
     def __str__(self, ntabs = 0):
         return "\t"*ntabs + "while (" + str(self.cond) + ")\n" + \
             self.statement.__str__(ntabs + 1)
 
 class Block(Statement):
+    __slots__ = ('name', 'statements')
+    _fields = ('name', 'statements')
     def __init__(self, name, statements):
         self.name = name
         self.statements = statements
     def parse_info(self, begin, end):
-        self.pos = (begin.pos_stack, _get_end(end))
+        self._set_pos(_start(begin), _stop(end))
         
     def __str__(self, ntabs=0):
         return "\t" * ntabs + "begin\n" + \
@@ -667,20 +1024,24 @@ class Block(Statement):
             "\t" * ntabs + "end"
 
 class TaskCall(Statement):
+    __slots__ = ('name', 'arguments')
+    _fields = ('name', 'arguments')
     def __init__(self, name, arguments):
         assert isinstance(name, Id)
         self.name = name
         self.arguments = arguments
     def parse_info(self, kw, semi):
-        self.pos = (kw.pos_stack, _get_end(semi))
+        self._set_pos(_start(kw), _stop(semi))
     def __str__(self, ntabs=0):
         return "\t" * ntabs + str(self.name) + '(' + ', '.join(str(x) for x in self.arguments) + ');'
 
 
 class Expression(Ast):
-    pass
+    __slots__ = ()
 
 class FunctionCall(Expression):
+    __slots__ = ('name', 'arguments')
+    _fields = ('name', 'arguments')
     def __init__(self, name, arguments):
         assert isinstance(name, Id)
         self.name = name
@@ -689,36 +1050,39 @@ class FunctionCall(Expression):
             a.parent = self
         self.arguments = arguments
     def parse_info(self, endparan):
-        self.pos = (self.name.pos[0], _get_end(endparan))
+        self._set_pos(_start(self.name), _stop(endparan))
     def __str__(self):
         return str(self.name) + '(' + ', '.join(str(x) for x in self.arguments) + ')'
 
 class Id(Expression):
+    __slots__ = ('value', 'block_comment', 'line_comment')
     def __init__(self, id_):
-        if hasattr(id_, 'pos_stack'):
-            self.pos = (id_.pos_stack, _get_end(id_))
-            self.value = id_.value
+        if _is_token(id_):
+            self._set_pos(_start(id_), _stop(id_))
+            # The same names are used over and over
+            self.value = sys.intern(id_.value)
             self.block_comment = getattr(id_.block_comment, "value", None)
-            self.id = id_
+            self.line_comment = getattr(id_.line_comment, "value", None)
+            # For a line comment lexed after the Id is made
+            id_.node = self
         else:
             assert isinstance(id_, str)
             self.value = id_
-    def __getattr__(self, name):
-        if name == "line_comment":
-            self.line_comment = getattr(id_.line_comment, "value", None)
-            return self.line_comment
-        else:
-            raise AttributeError(name)
     def __str__(self):
         # TODO: output escaped ids correctly
         return self.value
 
 
 class PartSelect(Expression):
+    __slots__ = ('id', 'type', 'expr', 'msb', 'lsb', 'size')
+    # Some of msb, lsb and size are made from the others
+    _type_fields = {'single': ('id', 'expr'),
+                    'range':  ('id', 'msb', 'lsb'),
+                    'plus':   ('id', 'lsb', 'size')}
     def __init__(self, **kwargs):
         self.id = kwargs['id']
-        if hasattr(self.id, 'pos'):
-            self.pos = (self.id.pos[0], kwargs['end'].pos_stack)
+        if _has_pos(self.id):
+            self._set_pos(_start(self.id), _start(kwargs['end']))
         self.type = kwargs['type']
         if self.type == "single":
             self.expr = kwargs["expr"]
@@ -742,6 +1106,9 @@ class PartSelect(Expression):
             self.msb.parent = self
         else:
             assert False
+    @property
+    def _fields(self):
+        return self._type_fields[self.type]
     def __str__(self):
         ret = self.id.value + "["
         if self.type == "single":
@@ -754,9 +1121,11 @@ class PartSelect(Expression):
         return ret
 
 class BinaryOp(Expression):
+    __slots__ = ('a', 'op', 'b')
+    _fields = ('a', 'b')
     def __init__(self, a, op, b):
-        if hasattr(a, 'pos'):
-            self.pos = (a.pos[0], b.pos[1])
+        if _has_pos(a):
+            self._set_pos(_start(a), _stop(b))
         self.a = a
         self.a.parent = self
         self.op = op
@@ -766,9 +1135,11 @@ class BinaryOp(Expression):
         return '(' + ' '.join(str(x) for x in (self.a, self.op, self.b)) + ')'
 
 class UnaryOp(Expression):
+    __slots__ = ('op', 'expr')
+    _fields = ('expr',)
     def __init__(self, op, expr):
-        if hasattr(op, 'pos_stack'):
-            self.pos = (op.pos_stack, expr.pos[1])
+        if _is_token(op):
+            self._set_pos(_start(op), _stop(expr))
         self.expr = expr
         self.expr.parent = self
         self.op = op.value
@@ -776,9 +1147,11 @@ class UnaryOp(Expression):
         return '(' + str(self.op) + str(self.expr) + ')'
 
 class Ternary(Expression):
+    __slots__ = ('cond', 'true', 'false')
+    _fields = ('cond', 'true', 'false')
     def __init__(self, cond, true, false):
-        if hasattr(cond, 'pos'):
-            self.pos = (cond.pos[0], false.pos[1])
+        if _has_pos(cond):
+            self._set_pos(_start(cond), _stop(false))
         self.cond = cond
         self.cond.parent = self
         self.true = true
@@ -790,47 +1163,57 @@ class Ternary(Expression):
             str(self.true) + ')\n\t\t: (' + str(self.false) + ')'
 
 class Repetition(Expression):
+    __slots__ = ('repeat', 'concat')
+    _fields = ('repeat', 'concat')
     def __init__(self, repeat, concat):
         self.repeat = repeat
         self.repeat.parent = self
         self.concat = concat
         self.concat.parent = self
     def parse_info(self, left, right):
-        self.pos = (left.pos_stack, _get_end(right))
+        self._set_pos(_start(left), _stop(right))
     def __str__(self):
         return '{' + str(self.repeat) + str(self.concat) + '}'
 
 class Concatenation(Expression):
+    __slots__ = ('expressions',)
+    _fields = ('expressions',)
     def __init__(self, expressions):
         self.expressions = expressions
         for e in expressions:
             e.parent = self
     def parse_info(self, left, right):
-        self.pos = (left.pos_stack, _get_end(right))
+        self._set_pos(_start(left), _stop(right))
         
     def __str__(self):
         return '{' + ', '.join(str(x) for x in self.expressions) + '}'
 
 
 class Genvars(Ast):
+    __slots__ = ('ids', 'range')
+    _fields = ('ids',)
     def __init__(self, ids):
         self.ids = ids
         self.range = None
     def parse_info(self, genvar):
-        self.pos = (genvar.pos_stack, self.ids[-1].pos[1])
+        self._set_pos(_start(genvar), _stop(self.ids[-1]))
     def __str__(self):
         return "genvar " + ', '.join(str(x) for x in self.ids) + ";"
 
 class Generate(Ast):
+    __slots__ = ('item',)
+    _fields = ('item',)
     def __init__(self, item):
         self.item = item
         item.parent = self
     def parse_info(self, generate, endgenerate):
-        self.pos = (generate.pos_stack, _get_end(endgenerate))
+        self._set_pos(_start(generate), _stop(endgenerate))
     def __str__(self):
         return "generate\n"+self.item.__str__(2) + "\n\tendgenerate"
 
 class GenerateBlock(Ast):
+    __slots__ = ('name', 'items')
+    _fields = ('name', 'items')
     def __init__(self, name, items):
         self.name = name
         self.items = items
@@ -838,13 +1221,15 @@ class GenerateBlock(Ast):
         for i in items:
             i.parent = self
     def parse_info(self, begin, end):
-        self.pos = (begin.pos_stack, _get_end(end))
+        self._set_pos(_start(begin), _stop(end))
     def __str__(self, ntabs = 0):
         return "\t" * ntabs + "begin : "+str(self.name)+"\n"+\
             '\n'.join(x.__str__(ntabs + 1) for x in self.items) + "\n" +\
             "\t" * ntabs + "end"
 
 class GenerateIf(Ast):
+    __slots__ = ('expression', 'true', 'false', 'last')
+    _fields = ('expression', 'true', 'false')
     def __init__(self, expression, true, false):
         self.expression = expression
         expression.parent = self
@@ -857,9 +1242,11 @@ class GenerateIf(Ast):
             false.parent = self
             self.last = false
     def parse_info(self, if_):
-        self.pos = (if_.pos_stack, self.last.pos[1])
+        self._set_pos(_start(if_), _stop(self.last))
 
 class GenerateFor(Ast):
+    __slots__ = ('init', 'cond', 'incr', 'item')
+    _fields = ('init', 'cond', 'incr', 'item')
     def __init__(self, init, cond, incr, item):
         self.init = init
         self.cond = cond
@@ -870,13 +1257,15 @@ class GenerateFor(Ast):
         incr.parent = self
         item.parent = self
     def parse_info(self, for_):
-        self.pos = (for_.pos_stack, self.item.pos[1])
+        self._set_pos(_start(for_), _stop(self.item))
     def __str__(self, ntabs = 0):
         return "\t" * ntabs +\
             "for ("+str(self.init)+"; "+str(self.cond)+"; "+str(self.incr)+")\n" \
             + self.item.__str__(ntabs + 1)
 
 class GenerateCaseItem(Ast):
+    __slots__ = ('expressions', 'item')
+    _fields = ('expressions', 'item')
     def __init__(self, expressions, item):
         self.expressions = expressions
         self.item = item
@@ -884,9 +1273,9 @@ class GenerateCaseItem(Ast):
         if expressions:
             for e in expressions:
                 e.parent = self
-            self.pos = (expressions[0].pos[0], item.pos[1])
+            self._set_pos(_start(expressions[0]), _stop(item))
     def parse_info(self, default):
-        self.pos = (default.pos_stack, self.item.pos[1])
+        self._set_pos(_start(default), _stop(self.item))
     def __str__(self, ntabs = 0):
         if self.expressions:
             return "\t" * ntabs + ', '.join(str(x) for x in self.expressions) + " :\n" +\
@@ -895,6 +1284,8 @@ class GenerateCaseItem(Ast):
             return "\t" * ntabs + "default :\n" + self.item.__str__(ntabs + 1)
 
 class GenerateCase(Ast):
+    __slots__ = ('expression', 'case_items')
+    _fields = ('expression', 'case_items')
     def __init__(self, expression, case_items):
         self.expression = expression
         expression.parent = self
@@ -902,7 +1293,7 @@ class GenerateCase(Ast):
         for i in case_items:
             i.parent = self
     def parse_info(self, case, endcase):
-        self.pos = (case.pos_stack, _get_end(endcase))
+        self._set_pos(_start(case), _stop(endcase))
     def __str__(self, ntabs=0):
         return "\t" * ntabs + "case ("+str(self.expression)+")\n" +\
             "\n".join(x.__str__(ntabs + 1) for x in self.case_items)+"\n"+\
@@ -910,6 +1301,7 @@ class GenerateCase(Ast):
 
 # Objects for emitting only:
 class Force(Assign):
+    __slots__ = ()
     def __init__(self, lval, rval):
         assert isinstance(lval, (Id, Concatenation, PartSelect))
         assert isinstance(rval, Expression)
@@ -919,6 +1311,8 @@ class Force(Assign):
         return "force " + str(self.lval) + " = " + str(self.rval) + ";"
 
 class Release(Statement):
+    __slots__ = ('lval',)
+    _fields = ('lval',)
     def __init__(self, lval):
         assert isinstance(lval, (Id, Concatenation, PartSelect))
         self.lval = lval
@@ -926,6 +1320,8 @@ class Release(Statement):
         return "release " + str(self.lval) + ";"
 
 class Delay(Statement):
+    __slots__ = ('delay_expr', 'statement')
+    _fields = ('delay_expr', 'statement')
     def __init__(self, delay_expr, statement):
         assert isinstance(delay_expr, Expression)
         assert isinstance(statement, Statement) or statement == None
@@ -936,3 +1332,143 @@ class Delay(Statement):
         if self.statement:
             return ret + " " + str(self.statement)
         return ret + ";"
+
+# Going through the tree:
+def iter_children(node):
+    "Yield the children of node, in the order of the source"
+    for name in node._fields:
+        value = getattr(node, name, None)
+        if isinstance(value, Ast):
+            yield value
+        elif isinstance(value, (list, tuple)):
+            for child in value:
+                if isinstance(child, Ast):
+                    yield child
+
+def walk(node):
+    """Yield node and every node below it, each before its children, in
+    the order of the source. Deep trees are gone through without
+    recursing"""
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        if node._fields:
+            children = list(iter_children(node))
+            children.reverse()
+            stack.extend(children)
+
+class _Methods(dict):
+    "The visit_ methods of visitor by node class, None where there is none"
+    def __init__(self, visitor):
+        self.visitor = visitor
+    def __missing__(self, cls):
+        method = self[cls] = getattr(self.visitor, 'visit_' + cls.__name__,
+                                     None)
+        return method
+
+class NodeVisitor(object):
+    """Goes through a tree, calling visit_<class name>(node), if defined,
+    for each node, as ast.NodeVisitor does
+
+    A visit_ method has to call generic_visit(node) for the nodes below
+    node to be visited. Nodes without a visit_ method are gone through
+    without recursing, unless visit or generic_visit is overridden."""
+    def visit(self, node):
+        "Visit node, and return what its visit_ method returns"
+        method = getattr(self, 'visit_' + type(node).__name__, None)
+        if method is None:
+            return self.generic_visit(node)
+        return method(node)
+
+    def _methods(self, generic):
+        """Return the methods to visit nodes with, by their class, None
+        for those to go on to the children of. generic is the
+        generic_visit of the class. They are looked up once for each
+        visitor, not for each generic_visit"""
+        tables = self.__dict__.setdefault('_visit_methods', {})
+        methods = tables.get(generic)
+        if methods is not None:
+            return methods
+        cls = type(self)
+        if cls.visit is not NodeVisitor.visit or \
+           cls.generic_visit is not generic:
+            # They have to be called for each node
+            methods = collections.defaultdict(lambda: self.visit)
+        else:
+            methods = _Methods(self)
+        tables[generic] = methods
+        return methods
+
+    def generic_visit(self, node):
+        "Visit the children of node"
+        methods = self._methods(NodeVisitor.generic_visit)
+        stack = list(iter_children(node))
+        stack.reverse()
+        while stack:
+            child = stack.pop()
+            method = methods[type(child)]
+            if method is None:
+                children = list(iter_children(child))
+                children.reverse()
+                stack.extend(children)
+            else:
+                method(child)
+
+class NodeTransformer(NodeVisitor):
+    """A NodeVisitor that replaces each node visited with what its visit_
+    method returns, as ast.NodeTransformer does
+
+    A node in a list is removed if None is returned, and replaced by
+    the nodes if a list is returned. Other children are set to what is
+    returned, None included. Only the tree is changed, not the source:
+    the ids of a module are not updated, and no edits are planned."""
+    def generic_visit(self, node):
+        "Replace the children of node with what visiting them returns"
+        methods = self._methods(NodeTransformer.generic_visit)
+        stack = [self._transform(node, methods)]
+        while stack:
+            child = next(stack[-1], None)
+            if child is None:
+                stack.pop()
+            else:
+                stack.append(self._transform(child, methods))
+        return node
+
+    def _transform(self, node, methods):
+        """Replace the children of node. Yields those without a visit_
+        method, which are to be gone through before going on"""
+        for name in node._fields:
+            value = getattr(node, name, None)
+            if isinstance(value, (list, tuple)):
+                new_values = []
+                for child in value:
+                    method = None
+                    if isinstance(child, Ast):
+                        method = methods[type(child)]
+                    if method is None:
+                        if isinstance(child, Ast):
+                            yield child
+                        new_values.append(child)
+                        continue
+                    new = method(child)
+                    if new is None:
+                        continue
+                    if isinstance(new, Ast):
+                        new = [new]
+                    for n in new:
+                        n.parent = node
+                        new_values.append(n)
+                if type(value) is tuple:
+                    setattr(node, name, tuple(new_values))
+                else:
+                    value[:] = new_values
+            elif isinstance(value, Ast):
+                method = methods[type(value)]
+                if method is None:
+                    yield value
+                    continue
+                new = method(value)
+                if new is not None:
+                    new.parent = node
+                setattr(node, name, new)
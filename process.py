@@ -14,73 +14,491 @@
 # You should have received a copy of the GNU General Public License
 # along with metav.  If not, see <http://www.gnu.org/licenses/>.
 
-from metav.preproc import preproc
+from metav.preproc import preproc, preproc_iter
 from metav.lex import vLexer
-from metav.parse import vParser
+from metav.parse import vParser, parse, parse_header
+from metav.sourcemap import SourceMap
+from metav.astcache import AstCache
+from metav.design import Design
+import metav.modpath
+import metav.daemon
+import metav.manifest
+import metav.stats
+import json
 import metav.vast
 import metav.edit
 import os.path
+import time
+import glob
+import traceback
+import hashlib
+import concurrent.futures
 
 def _find_file(modulename, modpath=('.',)):
-    if "." not in modulename:
-        modulename += ".v"
-    for p in modpath:
-        filename = os.path.join(p, modulename)
-        #print("Trying " + filename)
-        if os.path.isfile(filename):
-            return filename
-    raise IOError("Could not find "+modulename + " in " + ', '.join(modpath))
-            
-
-def process(top, modpath=('.',), incpath=('.',), debug=False, module_dict={}):
+    # The directories are read once, and again by refresh_modpaths
+    return metav.modpath.index(modpath).find(modulename)
+
+def refresh_modpaths():
+    """Look for module files added or removed since the module path was
+    read. Callers that stay up, such as the daemon, call it before
+    processing again. Returns True if anything changed"""
+    return metav.modpath.refresh()
+
+
+def _preproc(top, modpath, incpath, stream=False):
+    """Return (text, sourcemap, edit_plan, includes, files) of the file
+    with top, where files are as for metav.vast.Module.files
+
+    If stream is true, text is an iterator over pieces of it, and the
+    rest is only complete when it has been gone through"""
+    filename = _find_file(top, modpath=modpath)
+    st = os.stat(filename)
+    # The files are stamped as they are read, as by metav.design
+    scope = {'uses': {}, 'defines': {}, 'guards': {},
+             'stamps': [(filename, st.st_mtime_ns, st.st_size)]}
+    sourcemap = SourceMap()
+    state = {'incpath': incpath, 'sourcemap': sourcemap,
+             'include_scopes': [scope]}
+    if stream:
+        p, edit_plan, includes = preproc_iter(filename, state)
+    else:
+        p, edit_plan, includes = preproc(filename, state)
+    return p, sourcemap, edit_plan, includes, scope['stamps']
+
+def _signature(module):
+    """Return a hash of the ports and parameters of module, which should
+    have had its metav code executed"""
+    ports = [x.value if hasattr(x, 'value') else str(x)
+             for x in module.modports or []]
+    decls = sorted(str(d) for decls in module.ids.values() for d in decls
+                   if d.type == 'port' or
+                   (d.type == 'parameter' and d.subtype != 'localparam'))
+    text = '\n'.join([module.name.value] + ports + decls)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def _interface(name, modpath, incpath):
+    """Return (stamps of the files of module name, signature of it once
+    processed)"""
+    module = process(name, modpath=modpath, incpath=incpath)
+    return (metav.manifest.stamps([f[0] for f in module.files]),
+            _signature(module))
+
+def _instantiated(module, signatures=False):
+    """Return a dict mapping the names of the modules module instantiates
+    to (files, signature) once processed, if signatures is true, else
+    to None"""
+    ret = {}
+    for name in sorted(module.insts):
+        if not signatures:
+            ret[name] = None
+            continue
+        inst = module.insts[name].get_module()
+        # A lazy module executes its metav code when the rest is parsed
+        inst.metav
+        ret[name] = (inst.files, _signature(inst))
+    return ret
+
+def _parse(p, sourcemap, debug, cache):
+    """Return the modules in p, from cache if it has them. p can only be
+    an iterator over pieces of the text if cache is None"""
+    modules = None
+    if cache is not None:
+        key = cache.key(p, sourcemap)
+        modules = cache.load(key)
+    if modules is None:
+        modules = parse(p, sourcemap, debug=debug)
+        if cache is not None:
+            cache.store(key, modules)
+    return modules
+
+def _setup(module, get_module, edit_plan, includes):
+    for iname in module.insts:
+        inst = module.insts[iname]
+        assert isinstance(inst, metav.vast.ModuleInsts)
+        inst._get_module = get_module
+    module.edit_plan = edit_plan
+    module.execute_metav(get_module, includes)
+
+def process(top, modpath=('.',), incpath=('.',), debug=False, module_dict=None,
+            cache=None, lazy=False):
+    """Parse top and the modules it instantiates, and execute the metav
+    code in them
+
+    cache may be a metav.astcache.AstCache to get parsed modules from.
+    If lazy is true, instantiated modules only get their headers and
+    ports parsed, and the rest when it is used. See process_header.
+
+    module_dict maps names to modules already processed. By default a
+    new one is made for each call."""
+    if module_dict is None:
+        module_dict = {}
     def get_module(name):
         nonlocal modpath, incpath, debug
+        if lazy:
+            return process_header(name, modpath=modpath, incpath=incpath,
+                                  debug=debug, module_dict=module_dict,
+                                  cache=cache)
         ret = process(name, modpath=modpath, incpath=incpath,
-                      debug=debug, module_dict=module_dict)
+                      debug=debug, module_dict=module_dict, cache=cache)
         return ret
     if top in module_dict:
+        metav.stats.count('module_cache_hits')
         return module_dict[top]
-    lexer = vLexer()
-    parser = vParser()
-    filename = _find_file(top, modpath=modpath)
-    p, edit_plan, includes = preproc(filename, state = {'incpath': incpath,})
-    #print(p)
-    modules = parser.parse(input=p, lexer=lexer, debug=debug)
+    metav.stats.count('module_cache_misses')
+    # The cache needs the whole text for its key. Without one the text
+    # goes to the parser as it is preprocessed, and is never all kept
+    p, sourcemap, edit_plan, includes, files = _preproc(top, modpath, incpath,
+                                                        stream=cache is None)
+    modules = _parse(p, sourcemap, debug, cache)
     for module in modules:
+        module.files = files
         module_dict[module.name.value] = module
     for module in modules:
         name = module.name.value
         if not top.startswith(name):
             print("Skipping module %s" % name)
             continue
-        
-        for iname in module.insts:
-            inst = module.insts[iname]
-            assert isinstance(inst, metav.vast.ModuleInsts)
-            inst._get_module = get_module
-        module.edit_plan = edit_plan
-        module.execute_metav(get_module, includes)
+        _setup(module, get_module, edit_plan, includes)
         return module
     assert False
-    
+
+def process_header(top, modpath=('.',), incpath=('.',), debug=False,
+                   module_dict=None, cache=None):
+    """Like process, but only parse the header and the port and
+    parameter declarations of top
+
+    Returns a metav.vast.LazyModule. The rest of it is parsed, and its
+    metav code executed, when its items, insts or metav are used.
+    Modules it instantiates are processed the same way."""
+    if module_dict is None:
+        module_dict = {}
+    def get_module(name):
+        return process_header(name, modpath=modpath, incpath=incpath,
+                              debug=debug, module_dict=module_dict,
+                              cache=cache)
+    if top in module_dict:
+        metav.stats.count('module_cache_hits')
+        return module_dict[top]
+    metav.stats.count('module_cache_misses')
+    p, sourcemap, edit_plan, includes, files = _preproc(top, modpath, incpath)
+    parsed = []
+    def load(module):
+        if not parsed:
+            parsed.extend(_parse(p, sourcemap, debug, cache))
+        for full in parsed:
+            if full.name.value == module.name.value:
+                module.set_body(full)
+        if module is ret:
+            _setup(module, get_module, edit_plan, includes)
+    ret = None
+    for header in parse_header(p, sourcemap):
+        module = metav.vast.LazyModule(header, load)
+        module.files = files
+        name = module.name.value
+        module_dict[name] = module
+        if ret is None and top.startswith(name):
+            ret = module
+    assert ret is not None
+    return ret
+
+def parse_files(filenames, incpath=('.',), threads=None, cache=None):
+    """Preprocess and parse each of filenames, in up to threads threads
+
+    Returns the lists of modules in the order of filenames. Nothing
+    but the include cache, and cache if given, is shared between the
+    threads. This is most useful on free-threaded Python builds."""
+    def one(filename):
+        sourcemap = SourceMap()
+        state = {'incpath': incpath, 'sourcemap': sourcemap}
+        if cache is None:
+            p = preproc_iter(filename, state)[0]
+        else:
+            p = preproc(filename, state)[0]
+        return _parse(p, sourcemap, False, cache)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        return list(pool.map(one, filenames))
+
+def _batch_init(stats=False):
+    # Load the parse tables and build the lexer before the first top
+    vParser()
+    vLexer()
+    metav.stats.enable(stats)
+
+def _batch_one(top, modpath, incpath, cache_dir, lazy, database,
+               signatures):
+    start = time.perf_counter()
+    try:
+        if database:
+            design = Design(modpath=modpath, incpath=incpath,
+                            database=database)
+            try:
+                module = design.get_module(top)
+            finally:
+                design.close()
+        else:
+            cache = AstCache(cache_dir) if cache_dir else None
+            module = process(top, modpath=modpath, incpath=incpath,
+                             module_dict={}, cache=cache, lazy=lazy)
+        # Only strings and positions go back to the parent
+        plan = [(p[0], p[1], str(p[2])) if p[0] == 'insert' else tuple(p)
+                for p in module.edit_plan]
+        insts = _instantiated(module, signatures)
+        files = module.files
+        error = None
+    except Exception:
+        plan = []
+        insts = {}
+        files = None
+        error = traceback.format_exc()
+    return top, plan, time.perf_counter() - start, error, insts, files
+
+def _batch_worker(top, *args):
+    # What a worker measured goes back with the result
+    metav.stats.reset()
+    result = _batch_one(top, *args)
+    return result, metav.stats.report() if metav.stats.enabled else None
+
+def find_tops(modpath=('.',)):
+    "Return the names of the modules in the .v files in modpath"
+    tops = []
+    for p in modpath:
+        for filename in sorted(glob.glob(os.path.join(p, '*.v'))):
+            tops.append(os.path.basename(filename)[:-2])
+    return tops
+
+def process_batch(tops, modpath=('.',), incpath=('.',), jobs=None,
+                  cache_dir=None, lazy=False, database=None,
+                  signatures=False):
+    """Process each of tops on its own, in up to jobs worker processes
+
+    Returns a list of (top, edit_plan, seconds, error, insts, files), in
+    the order of tops, where inserted items in edit_plan are strings,
+    error is None or the traceback, insts maps the names of the modules
+    top instantiates to (files, signature) if signatures is true, as
+    update_manifest wants, else to None, and files is as for
+    metav.vast.Module.files. If jobs is 1, all is done in this process.
+    If database is given, modules are taken from a metav.design.Design
+    kept in it. What metav.stats measures in the workers is added to
+    it here."""
+    # Make sure the parse tables are on disk before the workers want them
+    vParser()
+    vLexer()
+    args = (modpath, incpath, cache_dir, lazy, database, signatures)
+    if jobs == 1:
+        return [_batch_one(top, *args) for top in tops]
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=_batch_init,
+            initargs=(metav.stats.enabled, )) as pool:
+        futures = [pool.submit(_batch_worker, top, *args) for top in tops]
+        results = []
+        for f in futures:
+            result, stats = f.result()
+            if stats is not None:
+                metav.stats.merge(stats)
+            results.append(result)
+        return results
+
+def update_manifest(manifest, tops, modpath=('.',), incpath=('.',),
+                    verbose=False):
+    """Return the tops that are not up to date in manifest, a
+    metav.manifest.Manifest, and a function recording their results
+
+    The function takes (top, edit_plan, insts, files) after the edit
+    plan is executed, with insts as from _instantiated with signatures
+    and files as for metav.vast.Module.files. A top is not recorded if
+    one of its files changed after it was read, so that the change
+    shows the next time, or if they can not be read."""
+    # Where files are looked for changes what they preprocess to. The
+    # preprocessor starts with no defines, and the defines files make
+    # are in their hashes
+    settings = {'modpath': [os.path.abspath(p) for p in modpath],
+                'incpath': [os.path.abspath(p) for p in incpath]}
+    interfaces = {}
+    def interface(name):
+        if name not in interfaces:
+            interfaces[name] = _interface(name, modpath, incpath)
+        return interfaces[name]
+    todo = [top for top in tops
+            if not manifest.up_to_date(top, interface, settings)]
+    # Files are hashed once, as many tops have some in common
+    stamped = {}
+    def stamps(files):
+        """Return the stamps of files, as in metav.vast.Module.files, or
+        None if one of them changed after it was read"""
+        ret = {}
+        for f, mtime, size in files:
+            if f not in stamped:
+                stamped[f] = metav.manifest.stamps([f])[f]
+            if stamped[f][:2] != [mtime, size]:
+                return None
+            ret[f] = stamped[f]
+        return ret
+    def record(top, plan, insts, files):
+        outputs = sorted(set(p[1][-1][1] + ".out" for p in plan))
+        try:
+            inputs = stamps(files)
+            ports = dict((name, (stamps(f), signature))
+                         for name, (f, signature) in insts.items())
+            outputs = metav.manifest.stamps(outputs)
+        except OSError as e:
+            if verbose:
+                print("Not recording %s in the manifest: %s" % (top, e))
+            return
+        if inputs is None or None in [p[0] for p in ports.values()]:
+            if verbose:
+                print("Not recording %s in the manifest: its files changed "
+                      "while it was processed" % top)
+            return
+        manifest.record(top, inputs, outputs, ports, settings)
+    return todo, record
+
+def apply_batch(results, verbose=False):
+    "Execute the edit plans from process_batch, one file at a time"
+    by_file = {}
+    for top, plan, seconds, error, insts, files in results:
+        for p in plan:
+            # Tops sharing a file make the same edits in it
+            by_file.setdefault(p[1][-1][1], dict())[p] = None
+    for filename in sorted(by_file):
+        metav.edit.execute(list(by_file[filename]), verbose=verbose)
+
+def _print_stats(text, json_file):
+    if text:
+        print(metav.stats.summary())
+    if json_file == '-':
+        print(json.dumps(metav.stats.report(), indent=1, sort_keys=True))
+    elif json_file:
+        with open(json_file, 'w') as f:
+            json.dump(metav.stats.report(), f, indent=1, sort_keys=True)
 
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description="Process metav scripts in verilog module")
-    parser.add_argument("top_module", metavar="TOP", type=str,
-                        help="the top module to process")
+    parser.add_argument("top_modules", metavar="TOP", type=str, nargs="*",
+                        help="the top modules to process")
     parser.add_argument("-I", "--include", metavar="INCDIR", type=str, nargs="+", default=["."],
                         help="list of include directories")
     parser.add_argument("-y", "--modpath", metavar="MODPATH", type=str, nargs="+", default=["."],
                         help="list of directories with module verilog files")
     parser.add_argument("-n", "--noop", action="store_true", default=False,
                         help="don't apply changes to file")
+    parser.add_argument("-v", "--verbose", action="store_true", default=False,
+                        help="print the edit plan as it is applied")
+    parser.add_argument("--cache-dir", metavar="DIR", type=str, default=None,
+                        help="directory to cache parsed modules in")
+    parser.add_argument("--db", metavar="FILE", type=str, default=None,
+                        help="SQLite file to keep the parsed design in, to parse only changed files")
+    parser.add_argument("--lazy", action="store_true", default=False,
+                        help="parse instantiated modules only as far as they are used")
+    parser.add_argument("-a", "--all", action="store_true", default=False,
+                        help="process every module in MODPATH")
+    parser.add_argument("-j", "--jobs", metavar="N", type=int, default=None,
+                        help="process tops in N worker processes (default: one per CPU)")
+    parser.add_argument("--manifest", metavar="FILE", type=str, default=None,
+                        help="skip the tops whose inputs are as recorded in FILE, and record the others")
+    parser.add_argument("--stats", action="store_true", default=False,
+                        help="print where the time went, and counts of what was done")
+    parser.add_argument("--stats-json", metavar="FILE", type=str, default=None,
+                        help="write the --stats numbers to FILE as JSON, - for standard output")
+    parser.add_argument("--serve", metavar="SOCKET", type=str, default=None,
+                        help="keep the design in memory, serving requests on UNIX socket SOCKET")
+    parser.add_argument("--watch", metavar="SECONDS", type=float, default=None,
+                        help="with --serve, check for changes every SECONDS, and process the tops served so far again")
+    parser.add_argument("--socket", metavar="SOCKET", type=str, default=None,
+                        help="have the daemon serving SOCKET process the tops, in its modpath and include path")
+    parser.add_argument("--stop", action="store_true", default=False,
+                        help="with --socket, stop the daemon")
     args = parser.parse_args()
 
-    mod = process(args.top_module, modpath=args.modpath, incpath=args.include)
-    #for p in mod.edit_plan:
-    #    print(p)
-    if not args.noop:
-        metav.edit.execute(mod.edit_plan)
+    if args.stats or args.stats_json:
+        metav.stats.enable()
+        import atexit
+        atexit.register(_print_stats, args.stats, args.stats_json)
+
+    if args.serve:
+        design = Design(modpath=args.modpath, incpath=args.include,
+                        database=args.db)
+        server = metav.daemon.Server(args.serve, design, interval=args.watch)
+        print("Serving on %s" % args.serve)
+        server.serve()
+        design.close()
+        raise SystemExit(0)
+    if args.socket and args.stop:
+        metav.daemon.request(args.socket, {'command': 'shutdown'})
+        raise SystemExit(0)
+
+    tops = args.top_modules
+    if args.all:
+        tops = tops + find_tops(args.modpath)
+    if not tops:
+        parser.error("no top modules given")
+    if args.socket:
+        reply = metav.daemon.request(args.socket, {'command': 'process',
+                                                   'tops': tops,
+                                                   'noop': args.noop})
+        failed = 0
+        for top, edits, seconds, error in reply['results']:
+            if error:
+                failed += 1
+                print("%-30s FAILED %8.3fs\n%s" % (top, seconds, error))
+            else:
+                print("%-30s %5d edits %8.3fs" % (top, edits, seconds))
+        if failed:
+            raise SystemExit(1)
+        raise SystemExit(0)
+    manifest = None
+    if args.manifest:
+        manifest = metav.manifest.Manifest(args.manifest)
+        count = len(tops)
+        tops, record = update_manifest(manifest, tops, modpath=args.modpath,
+                                       incpath=args.include,
+                                       verbose=args.verbose)
+        print("%d of %d tops up to date, skipped" % (manifest.skipped, count))
+        if not tops:
+            manifest.save()
+            raise SystemExit(0)
+    if len(tops) == 1 and args.jobs is None:
+        if args.db:
+            design = Design(modpath=args.modpath, incpath=args.include,
+                            database=args.db)
+            mod = design.get_module(tops[0])
+            design.close()
+        else:
+            cache = AstCache(args.cache_dir) if args.cache_dir else None
+            mod = process(tops[0], modpath=args.modpath, incpath=args.include,
+                          cache=cache, lazy=args.lazy)
+        #for p in mod.edit_plan:
+        #    print(p)
+        if not args.noop:
+            metav.edit.execute(mod.edit_plan, verbose=args.verbose)
+            if manifest:
+                record(tops[0], mod.edit_plan, _instantiated(mod, True),
+                       mod.files)
+                manifest.save()
+    else:
+        start = time.perf_counter()
+        results = process_batch(tops, modpath=args.modpath,
+                                incpath=args.include, jobs=args.jobs,
+                                cache_dir=args.cache_dir, lazy=args.lazy,
+                                database=args.db,
+                                signatures=manifest is not None)
+        failed = 0
+        for top, plan, seconds, error, insts, files in results:
+            if error:
+                failed += 1
+                print("%-30s FAILED %8.3fs\n%s" % (top, seconds, error))
+            else:
+                print("%-30s %5d edits %8.3fs" % (top, len(plan), seconds))
+        print("%d tops, %d failed, %.3fs" % (len(tops), failed,
+                                            time.perf_counter() - start))
+        if not args.noop:
+            apply_batch((r for r in results if not r[3]), verbose=args.verbose)
+            if manifest:
+                for top, plan, seconds, error, insts, files in results:
+                    if not error:
+                        record(top, plan, insts, files)
+                manifest.save()
+        if failed:
+            raise SystemExit(1)
 